@@ -10,16 +10,107 @@ import urllib.parse  # For URL encoding
 import requests  # For requests library
 import base64  # For image encoding
 import zipfile  # For creating zip files
-import io  # For in-memory file operations
+import hashlib  # For content hashes in the workspace index
+import hmac  # Signed session resume tokens
+import secrets
+import mimetypes  # For data-URI media types of binary assets
+import mmap  # For memory-mapped reads of large assets
+import shutil  # For streaming uploads to disk
+from concurrent.futures import ThreadPoolExecutor  # For parallel variant generation
+from collections import Counter, OrderedDict, deque  # For template search, the data-URI cache and the generation queue
+from contextlib import contextmanager
+import itertools
+import math  # For BM25 template scoring
+import bisect  # For offset -> line lookups in the symbol index
+from html.parser import HTMLParser  # For tag-balance checks on generated HTML
+from html import escape as escape_html  # For model-filled template slots
+import logging
+import threading  # For the process-wide generation scheduler
+import uuid
+import atexit  # Final flush of the usage ledger
+import sqlite3  # Default shared state backend
+try:  # POSIX advisory file locks, so several app processes can share the workspace and state store
+    import fcntl
+except ImportError:
+    fcntl = None
+try:  # Optional: inotify (or the platform equivalent) for the workspace watcher; falls back to polling
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler, Observer = object, None
 
 # --- Configuration ---
 st.set_page_config(layout="wide", page_title="AI Web Builder", initial_sidebar_state="expanded")
 load_dotenv()  # Load environment variables from .env file FIRST
 
 # --- Constants ---
-WORKSPACE_DIR = Path("workspace")  # Directory for generated web files
+WORKSPACE_DIR = Path(os.getenv("WORKSPACE_DIR", "workspace"))  # Directory for generated web files; shared by every replica
 WORKSPACE_DIR.mkdir(exist_ok=True)
 CSS_FILENAME = "style.css"  # Conventional CSS filename for injection
+EXPORT_DIR = Path(".exports")  # Cached zip artifacts, keyed by workspace signature
+EXPORT_MAX_AGE_SECONDS = 600  # Zips for other workspace states are deleted once unused this long (another tab or replica may still serve them)
+BUILD_DIR = Path(os.getenv("BUILD_DIR", ".build"))  # Compiled pages with partials expanded, rebuilt incrementally
+MAX_INCLUDE_DEPTH = 8  # Partials may include partials, up to this deep
+VARIANTS_DIR = Path(".variants")  # Scratch workspaces for best-of-N variants, one folder per session
+TEMPLATES_PATH = Path("templates/sections.json")  # Local library of reusable HTML/CSS sections
+TEMPLATE_SUGGESTIONS = 3  # Templates offered to the model per request
+BINARY_EXTENSIONS = {  # Files handled as raw bytes (never decoded as UTF-8)
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".bmp", ".ico",
+    ".woff", ".woff2", ".ttf", ".otf", ".eot",
+    ".mp3", ".wav", ".ogg", ".mp4", ".webm", ".pdf", ".zip",
+}
+PRECOMPRESSED_EXTENSIONS = {  # Stored as-is in the zip; deflating them again only burns CPU
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".woff", ".woff2",
+    ".mp3", ".ogg", ".mp4", ".webm", ".zip",
+}
+MMAP_THRESHOLD = 1024 * 1024  # Assets larger than this are memory-mapped instead of read whole
+LARGE_FILE_THRESHOLD = 64 * 1024  # Text files above this many bytes are edited section by section
+SECTION_TARGET_CHARS = 4000  # Small CSS rules / lines are grouped into sections of about this size
+SAVE_DEBOUNCE_SECONDS = 2.0  # Section edits are coalesced and written at most this often
+SYMBOL_MAP_LIMIT = 150  # Max symbols listed in the map sent to the model
+WORKSPACE_WATCH = os.getenv("WORKSPACE_WATCH", "auto")  # "auto" (inotify if available), "poll" or "off"
+WATCH_POLL_SECONDS = 2.0  # Polling interval when inotify isn't available
+WATCH_SETTLE_SECONDS = 0.3  # Events for a path are handled once it has been quiet this long
+WATCH_REFRESH_SECONDS = float(os.getenv("WATCH_REFRESH_SECONDS", "3"))  # How often an open session polls WorkspaceEvents for external changes
+WATCH_SESSION_TTL_SECONDS = 3600  # Sessions that stop checking in are dropped from the watch list
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")  # Shared store for session histories, pre-warmed follow-ups and usage totals, see STATE_BACKENDS
+STATE_DIR = Path(os.getenv("STATE_DIR", ".state"))  # Database and lock files; replicas on one host (or a shared volume) point at the same folder
+PREWARM_CACHE_TTL_SECONDS = 3600  # Pre-warmed follow-ups stay usable this long
+SESSION_HISTORY_TTL_SECONDS = 7 * 24 * 3600  # Chat history kept for sessions that can be resumed with their signed cookie
+STATE_SECRET = os.getenv("STATE_SECRET")  # HMAC key for resume tokens; defaults to a random key created once in STATE_DIR
+RESUME_COOKIE = "website_builder_resume"  # Holds the signed resume token of the browser's session
+GLOBAL_MAX_INFLIGHT_GENERATIONS = int(os.getenv("GLOBAL_MAX_INFLIGHT_GENERATIONS", "0"))  # Concurrent Groq calls across all processes sharing STATE_DIR, 0 = no global cap
+DATA_URI_CACHE_SIZE = 256  # Max inlined assets kept in the data-URI cache
+MAX_INFLIGHT_GENERATIONS = int(os.getenv("MAX_INFLIGHT_GENERATIONS", "4"))  # Concurrent Groq calls per process
+MAX_QUEUED_GENERATIONS = int(os.getenv("MAX_QUEUED_GENERATIONS", "32"))  # Waiting requests before new ones are shed
+SCHEDULER_METRICS_PATH = os.getenv("SCHEDULER_METRICS_PATH")  # Optional JSON file with queue metrics
+QUEUE_POLL_SECONDS = 1.0  # How often a queued request refreshes its position
+MAX_VARIANTS = 4  # Upper bound for parallel best-of-N generations
+VARIANT_TEMPERATURES = [0.7, 1.0, 0.4, 1.2]  # One per variant, so the designs actually differ
+GROQ_OUTPUT_MODE = os.getenv("GROQ_OUTPUT_MODE", "json")  # "json": provider JSON mode, replies are {"operations": [...]}; "text": plain JSON-array replies
+MAX_CONTINUATIONS = 2  # Follow-up requests when a reply stops at max_tokens, before repairing locally
+GROQ_MAX_RETRIES = 2  # Retries for rate-limited (429) or 5xx responses
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+USAGE_RING_SIZE = 5000  # Recent call records kept in memory
+USAGE_LOG_PATH = Path(os.getenv("USAGE_LOG_PATH", ".usage/usage.jsonl"))  # Append-only log of every call
+USAGE_FLUSH_SECONDS = 30.0  # Records are written to USAGE_LOG_PATH at most this often
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "0"))  # Total tokens per session, 0 = unlimited
+USER_TOKEN_BUDGET = int(os.getenv("USER_TOKEN_BUDGET", "0"))  # Total tokens per user, 0 = unlimited
+USAGE_ADMIN_VIEW = os.getenv("USAGE_ADMIN_VIEW", "0") == "1"  # Per-user table on the Usage tab; user keys are usernames or session ids, so operators only
+TRUSTED_USER_HEADER = os.getenv("TRUSTED_USER_HEADER")  # Header an authenticating proxy sets to the signed-in user (e.g. X-Forwarded-User); unset = each session is its own user
+MODEL_PRICES = {  # USD per million (prompt, completion) tokens
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+}
+PREWARM_FOLLOWUPS = {  # Likely next prompts after a generation -> phrasings that count as asking for them
+    "Make it responsive so it works well on phones and tablets": ("make it responsive", "make the site responsive", "make it mobile friendly", "make it work on mobile"),
+    "Add a dark mode": ("add dark mode", "add a dark mode", "add a dark theme", "dark mode"),
+    "Change the colors to a different, harmonious color scheme": ("change colors", "change the colors", "change colours", "change the color scheme", "use different colors"),
+}
+PREWARM_TOKEN_BUDGET = int(os.getenv("PREWARM_TOKEN_BUDGET", "30000"))  # Tokens one pre-warm round may spend
+PREWARM_IDLE_WAIT_SECONDS = 30.0  # How long a pre-warm waits for idle capacity before giving up
+CONTINUE_PROMPT = "Your previous reply was cut off. Continue exactly where it stopped: output only the remaining characters, without repeating anything and without commentary or code fences."
+
+logger = logging.getLogger("website_builder")
 
 # --- Custom CSS for enhanced UI ---
 def get_custom_css():
@@ -456,46 +547,828 @@ if not GROQ_API_KEY:
 
 model_name = "llama-3.3-70b-versatile"
 
+# --- Prompt Prefix ---
+# These strings open every request. Keep them byte-stable: any edit invalidates provider-side prompt caches.
+_INSTRUCTION_INTRO = """You are an AI assistant that helps users create web pages and simple web applications.
+Your goal is to generate HTML, CSS, JavaScript code, or self-contained React preview files.
+"""
+
+_TEXT_FORMAT_RULES = """Based on the user's request, you MUST respond ONLY with a valid JSON array containing file operation objects.
+
+**JSON FORMATTING RULES (VERY IMPORTANT):**
+1.  The entire response MUST be a single JSON array starting with '[' and ending with ']'.
+2.  All keys (like "action", "filename", "content") MUST be enclosed in **double quotes** (").
+3.  All string values (like filenames and the large code content) MUST be enclosed in **double quotes** ("). Single quotes (') or backticks (`) are NOT ALLOWED for keys or string values in the JSON structure.
+4.  Special characters within the "content" string (like newlines, double quotes inside the code) MUST be properly escaped (e.g., use '\\n' for newlines, '\\"' for double quotes).
+
+**EXAMPLE of Correct JSON action object:**
+{
+    "action": "create_update",
+    "filename": "example.html",
+    "content": "<!DOCTYPE html>\\n<html>\\n<head>\\n  <title>Example</title>\\n</head>\\n<body>\\n  <h1>Hello World!</h1>\\n  <p>This contains a \\"quote\\" example.</p>\\n</body>\\n</html>"
+}
+
+Possible action objects in the JSON array:
+"""
+
+# JSON mode (GROQ_OUTPUT_MODE="json"): the provider only accepts an object at the top level and
+# guarantees valid JSON, so the array is wrapped and the escaping rules are left out
+_JSON_FORMAT_RULES = """Based on the user's request, you MUST respond with a single JSON object whose only field is "operations": an array of file operation objects, e.g. {"operations": [{"action": "chat", "content": "..."}]}.
+
+Possible objects in the "operations" array:
+"""
+
+_INSTRUCTION_BODY = """- {"action": "create_update", "filename": "path/to/file.ext", "content": "file content string here..."}
+- {"action": "delete", "filename": "path/to/file.ext"}
+- {"action": "chat", "content": "Your helpful answer string here..."}
+- {"action": "use_template", "template": "template-id", "filename": "path/to/page.html", "slots": {"slot-name": "text for this site"}}
+
+**TEMPLATES:**
+When a system message lists "Suggested templates", you may use one instead of writing that section yourself: put the marker <!-- template:template-id --> where the section belongs in the page you write with 'create_update', then add a 'use_template' action with the same id and filename after it. Fill every slot listed for the template with plain text (or an image URL) written for this site; slots you leave out keep generic placeholder copy. The app inserts the filled-in HTML at the marker and adds the template's CSS to 'style.css' after your own 'style.css' update. Only use ids from the suggested list.
+
+**VERY IMPORTANT - UPDATING FILES:**
+If the user asks you to modify an existing file (e.g., "add a footer to index.html", "change the button color in style.css"), you MUST provide the **ENTIRE**, complete, updated file content within the 'content' field of the 'create_update' action object, following all JSON formatting rules. Do NOT provide only the changed lines or a diff.
+
+**SHARED LAYOUT (MULTI-PAGE SITES):**
+When a site has more than one page, put the parts every page repeats (header, navigation, footer) in partial files whose names start with an underscore, e.g. '_header.html' and '_footer.html'. Pages include them with a comment on its own line: <!-- include: _header.html --> (path relative to the page). The app expands includes when previewing and exporting, and partials are not exported themselves. To change the navigation or footer, update only the partial with 'create_update' instead of rewriting every page.
+
+**REACT PREVIEWS:**
+If the user asks for a simple React component/app to preview, generate a SINGLE self-contained HTML file (e.g., 'react_preview.html') using 'create_update'. This file MUST use CDN links for React/ReactDOM/Babel, have a <div id="root">, include JSX in a <script type="text/babel"> tag, render to the root, and include CSS in <style> tags within the <head>. (Ensure valid JSON).
+
+**WORKSPACE CONTEXT:**
+After the conversation, system messages list the current files ("path bytes sha256-prefix") and a "Workspace symbols" map: each CSS class (.name), id (#name) and top-level JS name (function, class, const/let/var), followed by the files that define or use it. Use the map to keep names consistent across files, e.g. reuse existing classes in new pages and the ids that 'script.js' looks up. In earlier turns, file contents that were later rewritten or deleted are replaced by "[omitted: ...]"; the newest 'create_update' of each file in the conversation holds its current content.
+
+"""
+
+_TEXT_GENERAL = """**GENERAL:**
+Use standard filenames ('index.html', 'style.css', 'script.js'). The standard CSS file for injection is 'style.css'. If unsure, ask the user. Respond ONLY with the JSON array. Use 'chat' action for questions or explanations.
+
+**ESCAPING QUOTES:**
+When including HTML or CSS with attributes that contain quotes, you MUST properly escape all double quotes within the content. For example:
+- HTML: <div class="container"> should be written as <div class=\\"container\\">
+- CSS: font-family: "Times New Roman" should be written as font-family: \\"Times New Roman\\"
+"""
+
+_JSON_GENERAL = """**GENERAL:**
+Use standard filenames ('index.html', 'style.css', 'script.js'). The standard CSS file for injection is 'style.css'. If unsure, ask the user. Respond ONLY with the {"operations": [...]} object. Use 'chat' action for questions or explanations.
+"""
+
+SYSTEM_INSTRUCTION = _INSTRUCTION_INTRO + _TEXT_FORMAT_RULES + _INSTRUCTION_BODY + _TEXT_GENERAL
+JSON_MODE_INSTRUCTION = _INSTRUCTION_INTRO + _JSON_FORMAT_RULES + _INSTRUCTION_BODY + _JSON_GENERAL
+
+ASSISTANT_ACK = "[{\"action\": \"chat\", \"content\": \"Okay, I understand the strict JSON formatting rules (double quotes, escaping) and the need to provide full file content on updates. I will respond only with the valid JSON array. Ready.\"}]"
+JSON_MODE_ACK = "{\"operations\": [{\"action\": \"chat\", \"content\": \"Okay, I will reply with a JSON object whose operations array holds the file operations, with the full file content on updates. Ready.\"}]}"
+
+def serialize_operations(commands):
+    """Executed commands as the model would have written them in the current output mode."""
+    return json.dumps({"operations": commands} if GROQ_OUTPUT_MODE == "json" else commands, ensure_ascii=False)
+
+def build_workspace_manifest(index):
+    """Compact, deterministic listing of the workspace: one 'path bytes hash' line per file."""
+    if not index:
+        return "Current files in workspace: None"
+    lines = [f"{rel_path} {index[rel_path]['size']} {index[rel_path]['hash'][:8]}" for rel_path in sorted(index)]
+    return "Current files in workspace (path bytes sha256-prefix):\n" + "\n".join(lines)
+
+# --- Shared State ---
+@contextmanager
+def file_lock(name, blocking=True):
+    """Exclusive lock on STATE_DIR/locks/<name>.lock, shared by every process using that folder.
+
+    Yields True once held, or False if blocking=False and another holder has it. Without fcntl
+    (Windows) nothing is locked, so only a single process is supported there.
+    """
+    lock_dir = STATE_DIR / "locks"
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with open(lock_dir / f"{name}.lock", "a+b") as f:
+        if fcntl is None:
+            yield True
+            return
+        try: fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try: yield True
+        finally: fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+_workspace_lock_state = threading.local()
+
+@contextmanager
+def workspace_lock():
+    """Serialize multi-step workspace changes across threads and processes (re-entrant per thread)."""
+    if getattr(_workspace_lock_state, "held", False):
+        yield
+        return
+    with file_lock("workspace"):
+        _workspace_lock_state.held = True
+        try: yield
+        finally: _workspace_lock_state.held = False
+
+class SQLiteStateStore:
+    """JSON key/value store with expiry in a SQLite file (WAL mode), safe for concurrent processes.
+
+    Holds session histories, pre-warmed follow-ups and usage totals. Sampled replies to ordinary
+    prompts are deliberately not cached: re-sending a prompt should give a new design.
+
+    A backend provides get, set, delete, add, items and slot; register others (e.g. one backed by Redis
+    for replicas on different nodes) in STATE_BACKENDS and select them with STATE_BACKEND.
+    """
+    def __init__(self, state_dir=STATE_DIR):
+        state_dir.mkdir(parents=True, exist_ok=True)
+        self.path = state_dir / "state.db"
+        self._local = threading.local()  # sqlite3 connections can't be shared between threads
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (namespace, key))")
+            db.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)")
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def get(self, namespace, key):
+        row = self._connect().execute("SELECT value, expires FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        if not row or (row[1] is not None and row[1] < time.time()): return None
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)", (namespace, key, json.dumps(value), now + ttl if ttl else None))
+            db.execute("DELETE FROM kv WHERE expires < ?", (now,))
+
+    def delete(self, namespace, key):
+        with self._connect() as db:
+            db.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def add(self, namespace, key, amounts, ttl=None):
+        """Atomically add numbers to the fields of the dict at key (missing fields start at 0). Returns the new dict."""
+        now, db = time.time(), self._connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")  # Take the write lock before reading, so concurrent adds can't lose updates
+            row = db.execute("SELECT value, expires FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            value = json.loads(row[0]) if row and (row[1] is None or row[1] >= now) else {}
+            for field, amount in amounts.items(): value[field] = value.get(field, 0) + amount
+            db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)", (namespace, key, json.dumps(value), now + ttl if ttl else None))
+        return value
+
+    def items(self, namespace):
+        """Every unexpired (key, value) pair in a namespace."""
+        rows = self._connect().execute("SELECT key, value FROM kv WHERE namespace = ? AND (expires IS NULL OR expires >= ?)",
+                                       (namespace, time.time())).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    @contextmanager
+    def slot(self, name, capacity, blocking=True):
+        """Hold one of `capacity` slots shared by every process. Yields True once held; blocks until
+        one is free, or yields False straight away when blocking=False.
+
+        Slots are file locks, so a crashed process never leaks one.
+        """
+        while True:
+            for slot_index in range(capacity):
+                with file_lock(f"{name}-{slot_index}", blocking=False) as held:
+                    if held:
+                        yield True
+                        return
+            if not blocking:
+                yield False
+                return
+            time.sleep(QUEUE_POLL_SECONDS)
+
+STATE_BACKENDS = {"sqlite": SQLiteStateStore}
+
+@st.cache_resource
+def get_state_store():
+    return STATE_BACKENDS[STATE_BACKEND]()
+
+SESSION_STATE_KEYS = ("messages", "last_prompt", "workspace_reset_needed")  # What survives a failover to another replica
+
+def persist_session():
+    """Save the chat history to the shared store when it changed since the last save."""
+    snapshot = {key: st.session_state[key] for key in SESSION_STATE_KEYS}
+    fingerprint = hashlib.sha256(json.dumps(snapshot, sort_keys=True).encode("utf-8")).hexdigest()
+    if st.session_state.get("persisted_fingerprint") == fingerprint: return
+    try: get_state_store().set("sessions", st.session_state.session_id, snapshot, ttl=SESSION_HISTORY_TTL_SECONDS)
+    except sqlite3.Error as e: logger.warning("could not persist session %s: %s", st.session_state.session_id, e); return
+    st.session_state.persisted_fingerprint = fingerprint
+
+@st.cache_resource
+def get_state_secret():
+    """Key for resume tokens: STATE_SECRET, or a random key created once in STATE_DIR and shared by every replica using it."""
+    if STATE_SECRET: return STATE_SECRET.encode("utf-8")
+    secret_path = STATE_DIR / "secret"
+    if not secret_path.exists():
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = STATE_DIR / f".secret.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f: f.write(secrets.token_hex(32))
+        try: os.link(tmp_path, secret_path)  # Atomic and never overwrites, so concurrent starts agree on one key
+        except FileExistsError: pass
+        finally: tmp_path.unlink(missing_ok=True)
+    return secret_path.read_text().strip().encode("utf-8")
+
+def resume_token(session_id, issued=None):
+    """'<session id>.<issued unix time>.<HMAC of both>'; the signed timestamp lets tokens expire server-side."""
+    payload = f"{session_id}.{int(time.time()) if issued is None else issued}"
+    return f"{payload}.{hmac.new(get_state_secret(), payload.encode('utf-8'), hashlib.sha256).hexdigest()}"
+
+def verify_resume_token(token):
+    """The session id a resume token was issued for, or None if it is malformed, expired or not signed by us."""
+    match = re.fullmatch(r"([0-9a-f]{32})\.([0-9]{1,12})\.[0-9a-f]{64}", token or "")
+    if not match: return None
+    session_id, issued = match.group(1), int(match.group(2))
+    # A copied cookie stops working after the history TTL, however long the browser would keep it
+    if not -60 <= time.time() - issued <= SESSION_HISTORY_TTL_SECONDS: return None
+    return session_id if hmac.compare_digest(resume_token(session_id, issued), token) else None
+
+def set_resume_cookie():
+    """Hand the browser its signed resume token. Streamlit can't send Set-Cookie, so the page sets it."""
+    token = resume_token(st.session_state.session_id)
+    st.components.v1.html(f"<script>parent.document.cookie = '{RESUME_COOKIE}={token}; path=/; max-age={SESSION_HISTORY_TTL_SECONDS}; SameSite=Strict';</script>", height=0)
+
+def restore_session(session_id):
+    """Load a session's chat history saved by any replica. Returns True if one was found."""
+    try: snapshot = get_state_store().get("sessions", session_id)
+    except sqlite3.Error as e: logger.warning("could not restore session %s: %s", session_id, e); return False
+    for key, value in (snapshot or {}).items(): st.session_state[key] = value
+    return snapshot is not None
+
 # --- Session State Initialization ---
 if "messages" not in st.session_state: st.session_state.messages = []
 if "selected_file" not in st.session_state: st.session_state.selected_file = None
 if "file_content" not in st.session_state: st.session_state.file_content = ""
 if "rendered_html" not in st.session_state: st.session_state.rendered_html = ""
+if "rendered_css_info" not in st.session_state: st.session_state.rendered_css_info = ""
 if "last_prompt" not in st.session_state: st.session_state.last_prompt = ""
 if "workspace_reset_needed" not in st.session_state: st.session_state.workspace_reset_needed = False
 if "active_tab" not in st.session_state: st.session_state.active_tab = "about"
 if "haptic_feedback" not in st.session_state: st.session_state.haptic_feedback = False
+if "saved_uploads" not in st.session_state: st.session_state.saved_uploads = set()
+if "session_id" not in st.session_state:
+    # Only a token we signed resumes a session, so after a failover another replica can restore the history
+    # without a guessable or displayed id being enough to read someone else's chat
+    try: resumed_session_id = verify_resume_token(st.context.cookies.get(RESUME_COOKIE))
+    except Exception: resumed_session_id = None
+    st.session_state.session_id = resumed_session_id or uuid.uuid4().hex
+    if resumed_session_id: restore_session(resumed_session_id)
+    st.session_state.resume_cookie_set = False  # Re-issued even on resume, so an active session's token doesn't expire
+if "variants" not in st.session_state: st.session_state.variants = []
+if "large_file" not in st.session_state: st.session_state.large_file = None
+if "pending_section_edit" not in st.session_state: st.session_state.pending_section_edit = None
 # rendered_for_{filename} marker is added/removed dynamically
 
+# --- Workspace Index ---
+@st.cache_resource
+def get_hash_cache():
+    """Process-wide cache of content hashes: scanned path -> (size, mtime_ns, sha256)."""
+    return {}
+
+def _hash_file(path, size, mtime_ns):
+    """Hash a file, reusing the cached digest while its size and mtime are unchanged."""
+    cache = get_hash_cache()
+    cached = cache.get(path)
+    if cached and cached[0] == size and cached[1] == mtime_ns:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    cache[path] = (size, mtime_ns, digest.hexdigest())
+    return cache[path][2]
+
+def scan_workspace(root=WORKSPACE_DIR):
+    """Recursively index a workspace with os.scandir.
+
+    Returns {relative posix path: {"path", "size", "mtime", "hash"}}. Hashes are only
+    recomputed for files whose size or mtime changed since the last scan, and cached
+    hashes of files that are gone are dropped.
+    """
+    index, seen = {}, set()
+    stack = [(str(root), "")]
+    while stack:
+        dir_path, prefix = stack.pop()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if is_temp_file(entry.name): continue  # Another process is mid-write
+                    rel_path = prefix + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, rel_path + "/"))
+                        elif entry.is_file(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            index[rel_path] = {
+                                "path": rel_path,
+                                "size": stat.st_size,
+                                "mtime": stat.st_mtime,
+                                "hash": _hash_file(entry.path, stat.st_size, stat.st_mtime_ns),
+                            }
+                            seen.add(entry.path)
+                    except FileNotFoundError:
+                        continue  # Deleted (e.g. by another replica) after it was listed; keep scanning its siblings
+        except FileNotFoundError:
+            continue
+    cache, root_prefix = get_hash_cache(), os.path.join(str(root), "")
+    for path in [path for path in list(cache) if path.startswith(root_prefix) and path not in seen]:
+        cache.pop(path, None)
+    return index
+
+# --- Preview Dependency Graph ---
+INCLUDE_PATTERN = re.compile(r"<!--\s*include:\s*([^\s>]+?)\s*-->")  # <!-- include: _header.html -->
+
+def extract_references(content, base_file):
+    """Workspace paths referenced from HTML/CSS via src=, href=, url() or an include directive."""
+    refs = set()
+    for ref in re.findall(r'\b(?:src|href)=["\']([^"\']+)["\']', content) + re.findall(r'url\(\s*["\']?([^)"\']+)["\']?\s*\)', content) + INCLUDE_PATTERN.findall(content):
+        rel_path = _resolve_workspace_ref(ref, base_file)
+        if rel_path: refs.add(rel_path)
+    return refs
+
+def _has_references(rel_path):
+    return Path(rel_path).suffix.lower() in (".html", ".htm", ".css")
+
+class PreviewDependencyGraph:
+    """Edges from HTML/CSS files to the files they reference, plus a version per file.
+
+    Workspace write events bump versions and re-parse only the written file. A page's
+    preview stamp covers the page and everything it (transitively) pulls in, so a
+    change re-renders exactly the previews that depend on it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deps = {}  # path -> set of referenced workspace paths
+        self._versions = {}  # path -> version of the last write we saw
+        self._clock = itertools.count(1)
+
+    def rebuild(self, index):
+        with self._lock:
+            self._deps.clear()
+            self._versions = {rel_path: next(self._clock) for rel_path in index}
+            for rel_path in index:
+                if _has_references(rel_path):
+                    self._deps[rel_path] = extract_references(read_file_content(rel_path) or "", rel_path)
+
+    def on_write(self, rel_path, content=None):
+        if _has_references(rel_path):
+            if content is None: content = read_file_content(rel_path) or ""
+            refs = extract_references(content, rel_path)
+        with self._lock:
+            self._versions[rel_path] = next(self._clock)
+            if _has_references(rel_path): self._deps[rel_path] = refs
+
+    def on_delete(self, rel_path):
+        with self._lock:
+            self._versions[rel_path] = next(self._clock)  # Dependents must notice the file is gone
+            self._deps.pop(rel_path, None)
+
+    def known_paths(self):
+        with self._lock: return set(self._versions)
+
+    def dependencies(self, page):
+        """Every file the page pulls in, directly or through its stylesheets. The injected CSS counts too."""
+        with self._lock:
+            seen, stack = set(), [page, CSS_FILENAME]
+            while stack:
+                rel_path = stack.pop()
+                if rel_path in seen: continue
+                seen.add(rel_path)
+                stack.extend(self._deps.get(rel_path, ()))
+            return seen
+
+    def stamp(self, page):
+        deps = self.dependencies(page)
+        with self._lock:
+            return tuple(sorted((rel_path, self._versions.get(rel_path, 0)) for rel_path in deps))
+
+@st.cache_resource
+def get_preview_graph():
+    graph = PreviewDependencyGraph()
+    graph.rebuild(scan_workspace())
+    return graph
+
+# --- Symbol Index ---
+SYMBOL_SOURCE_EXTENSIONS = {".html", ".htm", ".css", ".js", ".jsx", ".mjs"}
+JS_DEFINITION_PATTERN = re.compile(r"\b(?:function\s+([A-Za-z_$][\w$]*)|class\s+([A-Za-z_$][\w$]*)|(?:const|let|var)\s+([A-Za-z_$][\w$]*))")
+JS_DOM_REFERENCE_PATTERN = re.compile(r"""(getElementById|getElementsByClassName|querySelector(?:All)?|classList\.(?:add|remove|toggle|contains))\(\s*["'`]([^"'`]+)["'`]""")
+CSS_SELECTOR_NAME_PATTERN = re.compile(r"([.#])(-?[A-Za-z_][\w-]*)")
+
+def _line_lookup(content):
+    line_starts = [0] + [m.end() for m in re.finditer("\n", content)]
+    return lambda offset: bisect.bisect_right(line_starts, offset)
+
+def _css_symbols(css, line_of, base=0):
+    css = re.sub(r"/\*.*?\*/", lambda m: " " * len(m.group()), css, flags=re.DOTALL)  # Keep offsets
+    for rule in re.finditer(r"([^{}]+)\{", css):
+        if rule.group(1).lstrip().startswith("@"): continue  # @media / @keyframes preludes aren't selectors
+        for m in CSS_SELECTOR_NAME_PATTERN.finditer(rule.group(1)):
+            yield ("class" if m.group(1) == "." else "id", m.group(2), line_of(base + rule.start(1) + m.start()), "css")
+
+def _js_symbols(js, line_of, base=0):
+    depth, scanned = 0, 0
+    for m in JS_DEFINITION_PATTERN.finditer(js):
+        # Only top-level declarations; locals inside function bodies would just crowd the map
+        depth += js.count("{", scanned, m.start()) - js.count("}", scanned, m.start()); scanned = m.start()
+        if depth > 0: continue
+        yield ("js", next(g for g in m.groups() if g), line_of(base + m.start()), "js definition")
+    for m in JS_DOM_REFERENCE_PATTERN.finditer(js):
+        method, selector = m.groups()
+        if method == "getElementById": names = [("id", selector)]
+        elif method.startswith(("getElementsByClassName", "classList")): names = [("class", name) for name in selector.split()]
+        else: names = [("class" if p == "." else "id", name) for p, name in CSS_SELECTOR_NAME_PATTERN.findall(selector)]
+        for kind, name in names:
+            yield (kind, name, line_of(base + m.start()), "js")
+
+def extract_symbols(content, filename):
+    """(kind, name, line, role) for the classes, ids and JS identifiers a file defines or uses."""
+    suffix = Path(filename).suffix.lower()
+    line_of = _line_lookup(content)
+    if suffix == ".css":
+        yield from _css_symbols(content, line_of)
+    elif suffix in (".js", ".jsx", ".mjs"):
+        yield from _js_symbols(content, line_of)
+    elif suffix in (".html", ".htm"):
+        for m in re.finditer(r'\b(class|id)\s*=\s*["\']([^"\']*)["\']', content):
+            for name in m.group(2).split():
+                yield (m.group(1), name, line_of(m.start()), "html")
+        for m in re.finditer(r"<style[^>]*>(.*?)</style>", content, flags=re.DOTALL | re.IGNORECASE):
+            yield from _css_symbols(m.group(1), line_of, m.start(1))
+        for m in re.finditer(r"<script[^>]*>(.*?)</script>", content, flags=re.DOTALL | re.IGNORECASE):
+            yield from _js_symbols(m.group(1), line_of, m.start(1))
+
+class SymbolIndex:
+    """Cross-file index of class names, ids and JS identifiers, updated one file at a time."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_file = {}  # path -> list of (kind, name, line, role)
+        self._by_symbol = {}  # (kind, name) -> {path: [(line, role), ...]}
+
+    def update_file(self, rel_path, content):
+        symbols = list(extract_symbols(content, rel_path)) if content is not None else []
+        with self._lock:
+            for kind, name, _, _ in self._by_file.pop(rel_path, []):
+                files = self._by_symbol.get((kind, name), {})
+                files.pop(rel_path, None)
+                if not files: self._by_symbol.pop((kind, name), None)
+            if symbols: self._by_file[rel_path] = symbols
+            for kind, name, line, role in symbols:
+                self._by_symbol.setdefault((kind, name), {}).setdefault(rel_path, []).append((line, role))
+
+    def remove_file(self, rel_path):
+        self.update_file(rel_path, None)
+
+    def search(self, query, limit=50):
+        """Symbols whose name contains the query; a leading '.' or '#' restricts to classes or ids."""
+        query = query.strip()
+        kind = {".": "class", "#": "id"}.get(query[:1])
+        needle = (query[1:] if kind else query).lower()
+        with self._lock:
+            matches = [(k, n, dict(files)) for (k, n), files in self._by_symbol.items()
+                       if needle in n.lower() and (kind is None or k == kind)]
+        # Exact names first, then prefixes, then the rest
+        matches.sort(key=lambda m: (m[1].lower() != needle, not m[1].lower().startswith(needle), m[1].lower()))
+        return matches[:limit]
+
+    def symbol_map(self, limit=SYMBOL_MAP_LIMIT):
+        """Compact 'symbol: files' listing the model can use instead of reading whole files.
+
+        Symbols shared by the most files come first, so a truncated map keeps the cross-file ones.
+        """
+        with self._lock:
+            items = sorted(self._by_symbol.items(), key=lambda item: (-len(item[1]), item[0][0], item[0][1]))
+        if not items: return None
+        prefix = {"class": ".", "id": "#", "js": ""}
+        lines = [f"{prefix[kind]}{name}: {', '.join(sorted(files))}" for (kind, name), files in items[:limit]]
+        if len(items) > limit: lines.append(f"... {len(items) - limit} more")
+        return "Workspace symbols (.class, #id, JS identifier: files):\n" + "\n".join(lines)
+
+def format_symbol_kind(kind, name):
+    return {"class": f".{name}", "id": f"#{name}"}.get(kind, name)
+
+@st.cache_resource
+def get_symbol_index():
+    index = SymbolIndex()
+    for rel_path in scan_workspace():
+        if Path(rel_path).suffix.lower() in SYMBOL_SOURCE_EXTENSIONS:
+            index.update_file(rel_path, read_file_content(rel_path))
+    return index
+
+def _stat_signature(rel_path):
+    try:
+        stat = (WORKSPACE_DIR / rel_path).stat()
+        return (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return None
+
+class WorkspaceEvents:
+    """Fan-out point for workspace changes, whether made by the app or by external editors.
+
+    Keeps the preview graph and symbol index current, remembers the signature of the app's
+    own writes (so the watcher can ignore their echo), and flags the sessions an external
+    change affects so only those refresh.
+    """
+    def __init__(self, graph, symbols):
+        self.graph, self.symbols = graph, symbols
+        self._lock = threading.Lock()
+        self._own_writes = {}  # path -> (size, mtime_ns) after our last write, None after our delete
+        self._watched = {}  # session_id -> (paths the session currently shows, last check-in)
+        self._changed = {}  # session_id -> externally changed paths not yet picked up
+
+    def publish(self, rel_path, deleted=False, content=None, external=False):
+        created = rel_path not in self.graph.known_paths()
+        if not deleted and content is None and Path(rel_path).suffix.lower() in SYMBOL_SOURCE_EXTENSIONS:
+            try:
+                with open(WORKSPACE_DIR / rel_path, "r", encoding="utf-8") as f: content = f.read()
+            except (OSError, UnicodeDecodeError):
+                content = ""
+        if deleted: self.graph.on_delete(rel_path)
+        else: self.graph.on_write(rel_path, content)
+        if Path(rel_path).suffix.lower() in SYMBOL_SOURCE_EXTENSIONS:
+            if deleted: self.symbols.remove_file(rel_path)
+            else: self.symbols.update_file(rel_path, content)
+        with self._lock:
+            if not external:
+                self._own_writes[rel_path] = None if deleted else _stat_signature(rel_path)
+                return
+            self._own_writes.pop(rel_path, None)
+            for session_id, (paths, _) in self._watched.items():
+                # Creates and deletes change every session's file list; edits only matter where shown
+                if deleted or created or rel_path in paths:
+                    self._changed.setdefault(session_id, set()).add(rel_path)
+
+    def is_own_write(self, rel_path):
+        with self._lock:
+            return rel_path in self._own_writes and self._own_writes[rel_path] == _stat_signature(rel_path)
+
+    def watch(self, session_id, paths):
+        with self._lock:
+            now = time.monotonic()
+            self._watched[session_id] = (set(paths), now)
+            for stale in [sid for sid, (_, seen) in self._watched.items() if now - seen > WATCH_SESSION_TTL_SECONDS]:
+                self._watched.pop(stale); self._changed.pop(stale, None)
+
+    def take_changes(self, session_id):
+        """Externally changed paths that affect this session since the last call."""
+        with self._lock:
+            if session_id in self._watched:
+                self._watched[session_id] = (self._watched[session_id][0], time.monotonic())
+            return self._changed.pop(session_id, set())
+
+@st.cache_resource
+def get_workspace_events():
+    return WorkspaceEvents(get_preview_graph(), get_symbol_index())
+
+def notify_workspace_change(rel_path, deleted=False, content=None):
+    """Workspace write event: every save/upload/delete goes through here to keep derived state current."""
+    get_workspace_events().publish(rel_path, deleted, content)
+
+# --- Workspace Watcher ---
+class _WorkspaceEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type in ("opened", "closed_no_write"): return  # Reads don't change anything
+        self.watcher.queue(event.src_path)
+        if event.event_type == "moved": self.watcher.queue(event.dest_path)
+
+class WorkspaceWatcher:
+    """Pushes external edits under the workspace into WorkspaceEvents: inotify via watchdog, or polling."""
+    def __init__(self, events, root=WORKSPACE_DIR):
+        self.events = events
+        self.root = root.resolve()
+        self.mode = None
+        self._pending = {}  # abs path -> time of its latest raw event
+        self._cond = threading.Condition()
+
+    def queue(self, abs_path):
+        """Collect a raw event; bursts for one path (truncate, write, close) are handled once."""
+        with self._cond:
+            self._pending[abs_path] = time.monotonic()
+            self._cond.notify()
+
+    def _drain(self):
+        while True:
+            with self._cond:
+                while not self._pending: self._cond.wait()
+                now = time.monotonic()
+                settled = [path for path, seen in self._pending.items() if now - seen >= WATCH_SETTLE_SECONDS]
+                for path in settled: del self._pending[path]
+            for path in settled:
+                try: self.handle(path)
+                except Exception as e: logger.warning("workspace watcher failed on %s: %s", path, e)
+            if not settled: time.sleep(WATCH_SETTLE_SECONDS / 3)
+
+    def handle(self, abs_path):
+        try: rel_path = Path(abs_path).resolve().relative_to(self.root).as_posix()
+        except ValueError: return
+        if is_temp_file(Path(rel_path).name): return
+        deleted = not (self.root / rel_path).is_file()
+        # By the time a path settles, the app has recorded its own writes, so their echo is skipped here
+        if self.events.is_own_write(rel_path): return
+        logger.info("external workspace change path=%s deleted=%s", rel_path, deleted)
+        self.events.publish(rel_path, deleted=deleted, external=True)
+
+    def _snapshot(self):
+        snapshot, stack = {}, [self.root]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False): stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                continue
+        return snapshot
+
+    def _poll(self):
+        previous = self._snapshot()
+        while True:
+            time.sleep(WATCH_POLL_SECONDS)
+            current = self._snapshot()
+            for path in previous.keys() - current.keys(): self.queue(path)
+            for path, signature in current.items():
+                if previous.get(path) != signature: self.queue(path)
+            previous = current
+
+    def start(self, mode=WORKSPACE_WATCH):
+        if mode == "off": return self
+        threading.Thread(target=self._drain, name="workspace-events", daemon=True).start()
+        if mode != "poll" and Observer is not None:
+            try:
+                observer = Observer()
+                observer.schedule(_WorkspaceEventHandler(self), str(self.root), recursive=True)
+                observer.daemon = True
+                observer.start()
+                self.mode = "inotify"
+                return self
+            except Exception as e:  # e.g. inotify watch limit reached
+                logger.warning("native workspace watcher unavailable, polling instead: %s", e)
+        threading.Thread(target=self._poll, name="workspace-poller", daemon=True).start()
+        self.mode = "poll"
+        return self
+
+@st.cache_resource
+def get_workspace_watcher():
+    return WorkspaceWatcher(get_workspace_events()).start()
+
+@st.fragment(run_every=WATCH_REFRESH_SECONDS)
+def refresh_on_external_changes():
+    """Reruns this session only when an external change touches what it shows.
+
+    Streamlit can't push to a browser from a background thread, so each open session polls:
+    every WATCH_REFRESH_SECONDS this fragment checks the in-memory change set the watcher fills,
+    and only a change that affects the session costs a full rerun.
+    """
+    changed = get_workspace_events().take_changes(st.session_state.session_id)
+    if not changed: return
+    selected = st.session_state.selected_file
+    if selected in changed:
+        if (WORKSPACE_DIR / selected).is_file():
+            st.session_state.file_content = read_file_content(selected) or "" if not st.session_state.large_file else ""
+            st.session_state.pop(f"editor_{selected}", None)  # Let the editor pick up the new text
+        else:
+            st.session_state.selected_file = None; st.session_state.file_content = ""
+    st.rerun()
+
 # --- Helper Functions ---
 def get_workspace_files():
-    try: return sorted([f.name for f in WORKSPACE_DIR.iterdir() if f.is_file()])
+    try: return sorted(scan_workspace())
     except Exception as e: st.error(f"Error listing workspace files: {e}"); return []
 
+def is_binary_file(filename):
+    return Path(filename).suffix.lower() in BINARY_EXTENSIONS
+
 def read_file_content(filename):
+    """Read a text file from the workspace. Binary assets return None; use open_asset for those."""
     if not filename: return None
     if ".." in filename or filename.startswith(("/", "\\")): return None
+    if is_binary_file(filename): return None
     filepath = WORKSPACE_DIR / filename
     try:
         with open(filepath, "r", encoding="utf-8") as f: return f.read()
     except FileNotFoundError: return None
+    except UnicodeDecodeError: return None  # Undeclared binary file
     except Exception as e: st.error(f"Error reading file '{filename}': {e}"); return None
 
+def is_temp_file(name):
+    return name.startswith(".") and name.endswith(".tmp")
+
+@contextmanager
+def atomic_write(filepath):
+    """Yield a binary handle to a temp file that replaces filepath on success.
+
+    Other processes (and previews) see either the old file or the complete new one, never a partial write.
+    """
+    tmp_path = filepath.with_name(f".{filepath.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f: yield f
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
 def save_file_content(filename, content):
     if not filename: return False
     if ".." in filename or filename.startswith(("/", "\\")): return False
     filepath = WORKSPACE_DIR / filename
     try:
         filepath.parent.mkdir(parents=True, exist_ok=True)
-        with open(filepath, "w", encoding="utf-8") as f: f.write(content); return True
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            with atomic_write(filepath) as f: f.write(content)
+            notify_workspace_change(filename); return True
+        with atomic_write(filepath) as f: f.write(content.encode("utf-8"))
+        notify_workspace_change(filename, content=content); return True
     except Exception as e: st.error(f"Error saving file '{filename}': {e}"); return False
 
+def save_uploaded_file(filename, uploaded_file):
+    """Stream an uploaded file to the workspace without keeping a copy in session state."""
+    if not filename: return False
+    if ".." in filename or filename.startswith(("/", "\\")): return False
+    filepath = WORKSPACE_DIR / filename
+    try:
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        uploaded_file.seek(0)
+        with atomic_write(filepath) as f: shutil.copyfileobj(uploaded_file, f, 1 << 20)
+        notify_workspace_change(filename)
+        return True
+    except Exception as e: st.error(f"Error saving upload '{filename}': {e}"); return False
+
+@contextmanager
+def open_asset(filename, root=WORKSPACE_DIR):
+    """Yield a workspace file's bytes, memory-mapped when the file is large."""
+    filepath = root / filename
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+@st.cache_resource
+def get_data_uri_cache():
+    """Process-wide LRU of data URIs keyed by content hash, shared by every preview."""
+    return OrderedDict()
+
+def get_asset_data_uri(filename, index=None, root=WORKSPACE_DIR):
+    """Return a data: URI for a workspace asset, or None if it isn't an indexed file."""
+    entry = (index if index is not None else scan_workspace(root)).get(filename)
+    if not entry: return None
+    cache = get_data_uri_cache()
+    data_uri = cache.get(entry["hash"])
+    if data_uri is None:
+        mime_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        with open_asset(filename, root) as data:
+            data_uri = f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
+        cache[entry["hash"]] = data_uri
+        while len(cache) > DATA_URI_CACHE_SIZE:
+            cache.popitem(last=False)
+    cache.move_to_end(entry["hash"])
+    return data_uri
+
+def _resolve_workspace_ref(ref, base_file):
+    """Resolve a relative src/href/url() reference against the file that contains it."""
+    ref = ref.strip().split("#", 1)[0].split("?", 1)[0]
+    if not ref or ref.startswith(("data:", "http:", "https:", "//", "mailto:", "javascript:")):
+        return None
+    if ref.startswith("/"):
+        return ref.lstrip("/")
+    resolved = os.path.normpath(os.path.join(os.path.dirname(base_file), ref)).replace(os.sep, "/")
+    return None if resolved.startswith("..") else resolved
+
+def inline_assets(content, base_file, root=WORKSPACE_DIR):
+    """Replace references to binary workspace assets with data URIs so the sandboxed preview can load them.
+
+    root is the workspace the file belongs to (a variant's scratch folder for the variant grid).
+    """
+    index = scan_workspace(root)
+    def replace_ref(ref):
+        rel_path = _resolve_workspace_ref(ref, base_file)
+        if rel_path and is_binary_file(rel_path):
+            return get_asset_data_uri(rel_path, index, root)
+        return None
+    def replace_attr(m):
+        data_uri = replace_ref(m.group(3))
+        return f"{m.group(1)}={m.group(2)}{data_uri}{m.group(2)}" if data_uri else m.group(0)
+    def replace_url(m):
+        data_uri = replace_ref(m.group(2))
+        return f"url({m.group(1)}{data_uri}{m.group(1)})" if data_uri else m.group(0)
+    content = re.sub(r'\b(src|href)=(["\'])([^"\']+)\2', replace_attr, content)
+    return re.sub(r'url\(\s*(["\']?)([^)"\']+)\1\s*\)', replace_url, content)
+
 def delete_file(filename):
     if not filename: return False
     if ".." in filename or filename.startswith(("/", "\\")): return False
     filepath = WORKSPACE_DIR / filename
     try:
         os.remove(filepath)
+        notify_workspace_change(filename, deleted=True)
         if st.session_state.selected_file == filename:  # Clear state if selected file is deleted
             st.session_state.selected_file = None
             st.session_state.file_content = ""
@@ -506,11 +1379,17 @@ def delete_file(filename):
     except Exception as e: st.error(f"Error deleting file '{filename}': {e}"); return False
 
 def clear_workspace():
-    """Clear all files in the workspace directory."""
+    """Clear all files (including nested ones) in the workspace directory."""
     try:
-        for file_path in WORKSPACE_DIR.iterdir():
-            if file_path.is_file():
-                os.remove(file_path)
+        with workspace_lock():
+            for rel_path in scan_workspace():
+                os.remove(WORKSPACE_DIR / rel_path)
+                notify_workspace_change(rel_path, deleted=True)
+            # Remove the now-empty subdirectories, deepest first
+            for dir_path, _, _ in os.walk(WORKSPACE_DIR, topdown=False):
+                if Path(dir_path) != WORKSPACE_DIR:
+                    try: os.rmdir(dir_path)
+                    except OSError: pass  # Still holds something we don't manage (e.g. a symlink)
         # Reset session state related to files
         st.session_state.selected_file = None
         st.session_state.file_content = ""
@@ -524,106 +1403,889 @@ def clear_workspace():
         st.error(f"Error clearing workspace: {e}")
         return False
 
+def workspace_signature(index):
+    """Hash of every (path, content hash) pair; changes whenever any workspace file does."""
+    digest = hashlib.sha256()
+    for rel_path in sorted(index):
+        digest.update(f"{rel_path}\0{index[rel_path]['hash']}\n".encode("utf-8"))
+    return digest.hexdigest()
+
 def create_download_zip():
-    """Create a zip file containing all files in the workspace directory."""
+    """Return an open handle to a zip of the built site, keeping subfolders.
+
+    Pages come from the site build (partials expanded, partials themselves left out). The
+    archive is written straight to disk from file handles and reused until the workspace
+    signature changes, so reruns don't rebuild it.
+    """
     try:
-        # Create a BytesIO object
-        zip_buffer = io.BytesIO()
-        
-        # Create a zip file
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for file_path in WORKSPACE_DIR.iterdir():
-                if file_path.is_file():
-                    # Add file to zip
-                    zip_file.write(file_path, arcname=file_path.name)
-        
-        # Reset buffer position
-        zip_buffer.seek(0)
-        return zip_buffer
+        index = scan_workspace()
+        EXPORT_DIR.mkdir(exist_ok=True)
+        zip_path = EXPORT_DIR / f"{workspace_signature(index)[:16]}.zip"
+        if not zip_path.exists():
+            get_site_builder().build(index)
+            tmp_path = zip_path.with_suffix(f".{os.getpid()}.tmp")
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                for rel_path in sorted(index):
+                    if is_partial(rel_path): continue
+                    compression = zipfile.ZIP_STORED if Path(rel_path).suffix.lower() in PRECOMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                    source = BUILD_DIR / rel_path if is_page(rel_path) else WORKSPACE_DIR / rel_path
+                    # The build skips pages it can't read as text; export those as they are
+                    if not source.is_file(): source = WORKSPACE_DIR / rel_path
+                    # Add file to zip under its workspace-relative path
+                    try: zip_file.write(source, arcname=rel_path, compress_type=compression)
+                    except FileNotFoundError: logger.warning("export skipped %s: removed during the build", rel_path)
+            os.replace(tmp_path, zip_path)
+        else:
+            os.utime(zip_path)  # Still in use: keep it out of the age-based cleanup below
+        # Drop artifacts for older workspace states (and crashed writes) once nobody has used them for a while
+        cutoff = time.time() - EXPORT_MAX_AGE_SECONDS
+        for stale in itertools.chain(EXPORT_DIR.glob("*.zip"), EXPORT_DIR.glob("*.tmp")):
+            try:
+                if stale != zip_path and stale.stat().st_mtime < cutoff: stale.unlink(missing_ok=True)
+            except FileNotFoundError: pass  # Another process cleaned it up first
+        return open(zip_path, "rb")
     except Exception as e:
         st.error(f"Error creating zip file: {e}")
         return None
 
-def get_download_link(buffer, filename="project.zip", text="Download Project"):
-    """Generate a download link for a file."""
-    b64 = base64.b64encode(buffer.getvalue()).decode()
-    href = f'<a href="data:application/zip;base64,{b64}" download="{filename}" class="download-btn" onclick="this.classList.add(\'haptic-feedback\'); setTimeout(() => this.classList.remove(\'haptic-feedback\'), 150);"><i class="fas fa-download"></i> {text}</a>'
-    return href
+# --- Site Build ---
+def is_partial(rel_path):
+    """Partials ('_header.html') are only included into pages, never previewed or exported on their own."""
+    return Path(rel_path).name.startswith("_") and Path(rel_path).suffix.lower() in (".html", ".htm")
+
+def is_page(rel_path):
+    return Path(rel_path).suffix.lower() in (".html", ".htm") and not is_partial(rel_path)
+
+def expand_includes(content, base_file, read=read_file_content, depth=0):
+    """Replace <!-- include: ... --> directives with the (recursively expanded) partials.
+
+    read(rel_path) returns a workspace file's text or None. Returns (html, set of included paths).
+    """
+    included = set()
+    def replace_include(m):
+        rel_path = _resolve_workspace_ref(m.group(1), base_file)
+        if not rel_path: return m.group(0)
+        included.add(rel_path)
+        partial = read(rel_path)
+        if partial is None: return f"<!-- include not found: {m.group(1)} -->"
+        if depth >= MAX_INCLUDE_DEPTH: return f"<!-- include too deep: {m.group(1)} -->"
+        expanded, nested = expand_includes(partial, rel_path, read, depth + 1)
+        included.update(nested)
+        return expanded
+    return INCLUDE_PATTERN.sub(replace_include, content), included
+
+class SiteBuilder:
+    """Compiles every page into BUILD_DIR with its partials expanded.
+
+    Each built page remembers the content hashes of the page and the partials it pulled in,
+    so a build only recompiles the pages where one of those changed.
+    """
+    def __init__(self, build_dir=BUILD_DIR):
+        self.build_dir = build_dir
+        self._lock = threading.Lock()
+        self._stamps = {}  # page -> ((rel_path, content hash or None), ...) of its last build
+
+    def _is_current(self, page, index):
+        stamp = self._stamps.get(page)
+        return stamp is not None and all((index.get(rel_path) or {}).get("hash") == digest for rel_path, digest in stamp) \
+            and (self.build_dir / page).exists()
+
+    def build(self, index):
+        """Bring BUILD_DIR up to date with the workspace index. Returns the pages that were recompiled."""
+        rebuilt = []
+        with self._lock, file_lock("build"):
+            for page in sorted(rel_path for rel_path in index if is_page(rel_path)):
+                if self._is_current(page, index): continue
+                content = read_file_content(page)
+                if content is None: continue
+                html, included = expand_includes(content, page)
+                output_path = self.build_dir / page
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_write(output_path) as f: f.write(html.encode("utf-8"))
+                self._stamps[page] = ((page, index[page]["hash"]),) + tuple(
+                    (rel_path, (index.get(rel_path) or {}).get("hash")) for rel_path in sorted(included))
+                rebuilt.append(page)
+            for page in [page for page in self._stamps if page not in index]:
+                self._stamps.pop(page)
+                (self.build_dir / page).unlink(missing_ok=True)
+        if rebuilt: logger.info("site build recompiled %d page(s): %s", len(rebuilt), ", ".join(rebuilt[:10]))
+        return rebuilt
+
+@st.cache_resource
+def get_site_builder():
+    return SiteBuilder()
+
+def read_built_page(page, index=None):
+    """A page as it will be exported (partials expanded). Other files are read from the workspace as-is."""
+    if not is_page(page): return read_file_content(page)
+    get_site_builder().build(index if index is not None else scan_workspace())
+    try: return (BUILD_DIR / page).read_text(encoding="utf-8")
+    except FileNotFoundError: return None
+
+# --- Large File Editor ---
+def is_large_file(filename):
+    try: return (WORKSPACE_DIR / filename).stat().st_size > LARGE_FILE_THRESHOLD
+    except OSError: return False
+
+class _HTMLSectionSplitter(HTMLParser):
+    """Finds where each direct child of <body> starts, as (line, column) positions."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth, self.body_depth, self.cuts = 0, None, []
+
+    def handle_starttag(self, tag, attrs):
+        if self.body_depth is not None and self.depth == self.body_depth:
+            attrs = dict(attrs)
+            label = f"<{tag}" + (f" id={attrs['id']}" if attrs.get("id") else "") + (f" class={attrs['class']}" if attrs.get("class") else "") + ">"
+            self.cuts.append((self.getpos(), label))
+        if tag not in VOID_ELEMENTS:
+            self.depth += 1
+            if tag == "body": self.body_depth = self.depth
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS: return
+        if tag == "body" and self.body_depth is not None:
+            self.cuts.append((self.getpos(), "</body>"))
+            self.body_depth = None
+        self.depth = max(self.depth - 1, 0)
+
+def _group_cuts(cuts, content):
+    """Merge neighbouring cut points so no section is much smaller than SECTION_TARGET_CHARS."""
+    grouped = [(0, None)]
+    for offset, label in cuts:
+        if offset - grouped[-1][0] < SECTION_TARGET_CHARS and offset < len(content):
+            continue
+        grouped.append((offset, label))
+    return grouped[1:]
+
+def split_sections(content, filename):
+    """Split a file into editable sections: [(label, start, end)] as character offsets.
+
+    HTML splits at the direct children of <body>, CSS at top-level rule blocks,
+    everything else at line boundaries.
+    """
+    suffix = Path(filename).suffix.lower()
+    cuts = []
+    if suffix in (".html", ".htm"):
+        line_starts = [0] + [m.end() for m in re.finditer("\n", content)]
+        splitter = _HTMLSectionSplitter()
+        try:
+            splitter.feed(content); splitter.close()
+            cuts = [(line_starts[line - 1] + col, label) for (line, col), label in splitter.cuts]
+        except Exception:
+            cuts = []
+    elif suffix == ".css":
+        depth = 0
+        for m in re.finditer(r"[{}]", content):
+            depth = depth + 1 if m.group() == "{" else max(depth - 1, 0)
+            if depth == 0 and m.group() == "}":
+                cuts.append((m.end(), None))
+        cuts = _group_cuts(cuts, content)
+    if not cuts:
+        cuts = [(m.end(), None) for m in re.finditer("\n", content)]
+        cuts = _group_cuts(cuts, content)
+    bounds = [(0, "Start")] + [cut for cut in cuts if 0 < cut[0] < len(content)]
+    sections = []
+    for i, (start, label) in enumerate(bounds):
+        end = bounds[i + 1][0] if i + 1 < len(bounds) else len(content)
+        if end <= start: continue
+        line = content.count("\n", 0, start) + 1
+        snippet = label or content[start:end].strip().split("\n", 1)[0][:60]
+        sections.append((f"L{line}: {snippet}", start, end))
+    return sections
+
+def load_large_file(filename):
+    """Index a large file's sections as byte ranges; the text itself stays on disk."""
+    with open(WORKSPACE_DIR / filename, "r", encoding="utf-8", newline="") as f: content = f.read()
+    sections, byte_offset, char_offset = [], 0, 0
+    for label, start, end in split_sections(content, filename):
+        byte_offset += len(content[char_offset:start].encode("utf-8"))
+        length = len(content[start:end].encode("utf-8"))
+        sections.append({"label": label, "start": byte_offset, "end": byte_offset + length})
+        byte_offset += length; char_offset = end
+    stat = (WORKSPACE_DIR / filename).stat()
+    return {"name": filename, "signature": (stat.st_size, stat.st_mtime_ns), "sections": sections}
+
+def read_file_range(filename, start, end):
+    with open(WORKSPACE_DIR / filename, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8", errors="replace")
+
+def save_file_range(filename, start, end, text):
+    """Replace bytes [start, end) of a file by streaming a patched copy over it. Returns the size delta.
+
+    The unchanged prefix and tail are copied in chunks, never loaded whole, and the copy replaces
+    the file atomically, so previews and other replicas never see a half-written file.
+    """
+    data, filepath = text.encode("utf-8"), WORKSPACE_DIR / filename
+    with workspace_lock(), open(filepath, "rb") as src, atomic_write(filepath) as dst:
+        remaining = start
+        while remaining:
+            chunk = src.read(min(remaining, 1 << 20))
+            if not chunk: break
+            dst.write(chunk); remaining -= len(chunk)
+        dst.write(data)
+        src.seek(end); shutil.copyfileobj(src, dst, 1 << 20)
+    notify_workspace_change(filename)  # Only previews depending on this file re-render
+    return len(data) - (end - start)
+
+def queue_section_edit(editor_key, section):
+    """on_change handler: remember the edit; flush_section_edit writes it once the debounce window passes."""
+    st.session_state.pending_section_edit = {
+        "name": st.session_state.large_file["name"], "signature": st.session_state.large_file["signature"],
+        "section": section, "text": st.session_state[editor_key], "edited_at": time.monotonic(),
+    }
+
+def flush_section_edit(force=False):
+    """Write the pending section edit if it is old enough (or force). Returns True when something was saved."""
+    pending, large_file = st.session_state.pending_section_edit, st.session_state.large_file
+    if not pending: return False
+    if not force and time.monotonic() - pending["edited_at"] < SAVE_DEBOUNCE_SECONDS: return False
+    st.session_state.pending_section_edit = None
+    if not large_file or large_file["name"] != pending["name"]: return False
+    section = large_file["sections"][pending["section"]]
+    with workspace_lock():  # No other writer can change the file between the check and the write
+        try: stat = (WORKSPACE_DIR / pending["name"]).stat()
+        except OSError: stat = None
+        if not stat or (stat.st_size, stat.st_mtime_ns) != pending["signature"]:
+            st.warning(f"`{pending['name']}` changed on disk since it was loaded; your section edit was not saved.")
+            st.session_state.large_file = None
+            return False
+        delta = save_file_range(pending["name"], section["start"], section["end"], pending["text"])
+        stat = (WORKSPACE_DIR / pending["name"]).stat()
+    # Shift the ranges after the edit instead of re-splitting the whole file
+    section["end"] += delta
+    for later in large_file["sections"][pending["section"] + 1:]:
+        later["start"] += delta; later["end"] += delta
+    large_file["signature"] = (stat.st_size, stat.st_mtime_ns)
+    return True
+
+@st.fragment(run_every=SAVE_DEBOUNCE_SECONDS)
+def autosave_section_edits():
+    """Flushes debounced section edits in the background while the editor is open."""
+    pending = st.session_state.pending_section_edit
+    if pending and flush_section_edit():
+        st.caption(f"💾 Saved section of `{pending['name']}`")
+    elif st.session_state.pending_section_edit:
+        st.caption("✏️ Unsaved changes, saving shortly...")
+
+# --- Generation Scheduler ---
+class GenerationScheduler:
+    """Process-wide admission control for LLM calls.
+
+    At most max_inflight calls run at once. Waiting requests are queued per user and
+    admitted round-robin, so one user firing many prompts can't starve the others.
+    With global_max_inflight, admitted calls also take one of that many slots shared
+    by every process using the same state store.
+    """
+    def __init__(self, max_inflight, max_queued, store=None, global_max_inflight=0):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.store = store
+        self.global_max_inflight = global_max_inflight
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # user_id -> deque of tickets, front user is served next
+        self._ticket_ids = itertools.count()
+        self._inflight = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._wait_times = deque(maxlen=1000)
+
+    def _admission_order(self):
+        """Queued tickets in the order they will be admitted (one per user per round)."""
+        queues = [list(q) for q in self._queues.values()]
+        order = []
+        for round_index in range(max(map(len, queues), default=0)):
+            order.extend(q[round_index] for q in queues if round_index < len(q))
+        return order
+
+    def _admit_ready(self):
+        while self._inflight < self.max_inflight and self._queues:
+            user_id, queue = self._queues.popitem(last=False)
+            ticket = queue.popleft()
+            if queue: self._queues[user_id] = queue  # User goes to the back of the round
+            ticket["admitted"] = True
+            self._inflight += 1
+            self._admitted += 1
+            wait = time.monotonic() - ticket["enqueued"]
+            self._wait_times.append(wait)
+            logger.info("generation admitted user=%s wait=%.2fs in_flight=%d queued=%d", user_id, wait, self._inflight, self._queued())
+        self._cond.notify_all()
+
+    def _queued(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _cancel(self, ticket):
+        queue = self._queues.get(ticket["user_id"])
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue: self._queues.pop(ticket["user_id"])
+
+    def acquire(self, user_id, on_wait=None):
+        """Block until a slot is free. Returns a ticket, or None if the queue is too deep (request shed).
+
+        on_wait(position) is called while queued, with a 1-based position in the admission order.
+        """
+        with self._cond:
+            if self._inflight >= self.max_inflight and self._queued() >= self.max_queued:
+                self._rejected += 1
+                logger.warning("generation shed user=%s queued=%d", user_id, self._queued())
+                return None
+            ticket = {"id": next(self._ticket_ids), "user_id": user_id, "enqueued": time.monotonic(), "admitted": False}
+            self._queues.setdefault(user_id, deque()).append(ticket)
+            self._admit_ready()
+        try:
+            while True:
+                with self._cond:
+                    if ticket["admitted"]: break
+                    position = next(i for i, t in enumerate(self._admission_order(), 1) if t is ticket) if on_wait else None
+                # UI callbacks run without the lock, so other sessions' acquire/release never wait on them
+                if on_wait: on_wait(position)
+                with self._cond:
+                    if not ticket["admitted"]: self._cond.wait(timeout=QUEUE_POLL_SECONDS)
+        except BaseException:
+            # The session went away (or was rerun) while waiting; give up the place in line (or the slot)
+            with self._cond:
+                admitted = ticket["admitted"]
+                if not admitted: self._cancel(ticket)
+            if admitted: self.release(ticket)
+            raise
+        self._take_global_slot(ticket)
+        return ticket
+
+    def try_acquire_idle(self, user_id):
+        """Low-priority admission: a ticket only if nobody is queued and a slot stays free for
+        interactive requests, so with max_inflight == 1 nothing is admitted. Never waits; returns None otherwise.
+        """
+        with self._cond:
+            if self._queued() or self._inflight >= self.max_inflight - 1: return None
+            ticket = {"id": next(self._ticket_ids), "user_id": user_id, "enqueued": time.monotonic(), "admitted": True}
+            self._inflight += 1
+            self._admitted += 1
+        return ticket if self._take_global_slot(ticket, blocking=False) else None
+
+    def _take_global_slot(self, ticket, blocking=True):
+        """Also hold a cross-process slot when a global cap is set. Releases the ticket and returns False if none was taken."""
+        if self.store is None or not self.global_max_inflight: return True
+        slot = self.store.slot("generation", self.global_max_inflight, blocking=blocking)
+        try: held = slot.__enter__()
+        except BaseException:
+            self.release(ticket)
+            raise
+        if not held:
+            slot.__exit__(None, None, None)
+            self.release(ticket)
+            return False
+        ticket["global_slot"] = slot
+        return True
+
+    def release(self, ticket):
+        if "global_slot" in ticket: ticket.pop("global_slot").__exit__(None, None, None)
+        with self._cond:
+            if ticket.get("released"): return
+            ticket["released"] = True
+            self._inflight -= 1
+            self._admit_ready()
+            metrics = self._metrics()
+        if SCHEDULER_METRICS_PATH:
+            try:
+                with open(SCHEDULER_METRICS_PATH, "w", encoding="utf-8") as f: json.dump(metrics, f)
+            except OSError as e: logger.warning("could not write scheduler metrics: %s", e)
+
+    def _metrics(self):
+        waits = sorted(self._wait_times)
+        return {
+            "max_inflight": self.max_inflight,
+            "in_flight": self._inflight,
+            "queued": self._queued(),
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "updated": time.time(),
+        }
+
+    def metrics(self):
+        with self._cond:
+            return self._metrics()
+
+@st.cache_resource
+def get_generation_scheduler():
+    return GenerationScheduler(MAX_INFLIGHT_GENERATIONS, MAX_QUEUED_GENERATIONS, get_state_store(), GLOBAL_MAX_INFLIGHT_GENERATIONS)
+
+def get_user_id():
+    """User identity for fair queueing and budgets: the trusted proxy's user header, else the session.
+
+    Client-supplied headers (X-Forwarded-For and friends) are never used, since anyone can set them
+    to dodge a budget or spend someone else's.
+    """
+    if TRUSTED_USER_HEADER:
+        try: value = (st.context.headers or {}).get(TRUSTED_USER_HEADER)
+        except Exception: value = None
+        if value: return value.strip()
+    return st.session_state.session_id
+
+# --- Template Library ---
+def _tokenize(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+class TemplateIndex:
+    """In-process BM25 index over each template's id, tags and description. Works fully offline."""
+    def __init__(self, templates, k1=1.5, b=0.75):
+        self.templates = {template["id"]: template for template in templates}
+        self.k1, self.b = k1, b
+        self._docs = {
+            template["id"]: Counter(_tokenize(" ".join([template["id"].replace("-", " "), " ".join(template.get("tags", [])), template.get("description", "")])))
+            for template in templates
+        }
+        self._avg_len = sum(sum(doc.values()) for doc in self._docs.values()) / max(len(self._docs), 1)
+        doc_freq = Counter(term for doc in self._docs.values() for term in doc)
+        n = len(self._docs)
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def search(self, query, limit=TEMPLATE_SUGGESTIONS):
+        """Best-matching templates for a free-text query, highest score first; no match returns []."""
+        terms = [term for term in set(_tokenize(query)) if term in self._idf]
+        scores = []
+        for template_id, doc in self._docs.items():
+            doc_len = sum(doc.values())
+            score = sum(
+                self._idf[term] * doc[term] * (self.k1 + 1) / (doc[term] + self.k1 * (1 - self.b + self.b * doc_len / self._avg_len))
+                for term in terms if term in doc
+            )
+            if score > 0: scores.append((score, template_id))
+        return [self.templates[template_id] for _, template_id in sorted(scores, reverse=True)[:limit]]
+
+@st.cache_resource
+def _load_template_index(mtime):
+    try:
+        with open(TEMPLATES_PATH, "r", encoding="utf-8") as f: return TemplateIndex(json.load(f))
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning("template library unavailable: %s", e)
+        return TemplateIndex([])
+
+def get_template_index():
+    """The template index, reloaded whenever the library file changes."""
+    try: mtime = TEMPLATES_PATH.stat().st_mtime
+    except OSError: mtime = None
+    return _load_template_index(mtime)
+
+def build_template_suggestions(query):
+    """Compact list of templates relevant to the prompt, or None when nothing matches."""
+    matches = get_template_index().search(query)
+    if not matches: return None
+    return "Suggested templates (id: description [slots]):\n" + "\n".join(
+        f"- {t['id']}: {t['description']} [{', '.join(t.get('slots', {}))}]" for t in matches)
+
+SLOT_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+def fill_template_slots(template, slots=None):
+    """Template HTML with each {{slot}} replaced by the model's text (escaped), else the library default."""
+    values = {**template.get("slots", {}), **{k: str(v) for k, v in (slots if isinstance(slots, dict) else {}).items()}}
+    return SLOT_PATTERN.sub(lambda m: escape_html(values.get(m.group(1), ""), quote=True), template["html"])
+
+def apply_template(template, page, slots=None):
+    """Expand a template into a page, at its marker, else before </body>."""
+    html = fill_template_slots(template, slots)
+    marker = f"<!-- template:{template['id']} -->"
+    if marker in page: return page.replace(marker, html)
+    if "</body>" in page: return page.replace("</body>", f"{html}\n</body>", 1)
+    return f"{page}{html}\n"
+
+def merge_template_css(templates, css):
+    """Append each template's CSS to a stylesheet once, tagged so a repeat use doesn't duplicate it."""
+    for template in templates:
+        css_marker = f"/* template:{template['id']} */"
+        if template.get("css") and css_marker not in css:
+            css = f"{css.rstrip()}\n\n{css_marker}\n{template['css']}\n".lstrip()
+    return css
+
+# --- Output Validation & Repair ---
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+OPTIONAL_CLOSE_ELEMENTS = {"p", "li", "dt", "dd", "tr", "td", "th", "thead", "tbody", "tfoot", "option", "colgroup"}
+
+class _TagBalanceChecker(HTMLParser):
+    """Tracks the elements still open at the end of a document."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.open_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_ELEMENTS and tag not in OPTIONAL_CLOSE_ELEMENTS:
+            self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.open_tags:
+            # Close it and anything left open inside it
+            del self.open_tags[len(self.open_tags) - 1 - self.open_tags[::-1].index(tag):]
+
+def repair_html(content):
+    """Close elements left open (typically by a truncated reply). Returns (content, notes)."""
+    notes = []
+    if content.rfind("<") > content.rfind(">"):
+        content = content[:content.rfind("<")].rstrip()
+        notes.append("dropped a cut-off tag")
+    checker = _TagBalanceChecker()
+    try:
+        checker.feed(content); checker.close()
+    except Exception:
+        return content, notes
+    if checker.open_tags:
+        content = content.rstrip() + "\n" + "".join(f"</{tag}>" for tag in reversed(checker.open_tags))
+        notes.append(f"closed {len(checker.open_tags)} unclosed element(s)")
+    return content, notes
+
+def repair_css(content):
+    """Balance braces and comments: drops stray '}' and closes open blocks. Returns (content, notes)."""
+    notes = []
+    out, depth, stray, i = [], 0, 0, 0
+    in_comment, quote = False, None
+    while i < len(content):
+        ch = content[i]
+        if in_comment:
+            if content.startswith("*/", i): in_comment = False; out.append("*/"); i += 2; continue
+        elif quote:
+            if ch == "\\": out.append(content[i:i + 2]); i += 2; continue
+            if ch == quote or ch == "\n": quote = None
+        elif content.startswith("/*", i): in_comment = True; out.append("/*"); i += 2; continue
+        elif ch in "\"'": quote = ch
+        elif ch == "{": depth += 1
+        elif ch == "}":
+            if depth == 0: stray += 1; i += 1; continue
+            depth -= 1
+        out.append(ch); i += 1
+    content = "".join(out)
+    if stray: notes.append(f"removed {stray} stray '}}'")
+    if in_comment: content += " */"; notes.append("closed an unterminated comment")
+    if quote: content += quote
+    if depth:
+        if content.rstrip() and content.rstrip()[-1] not in ";{}": content = content.rstrip() + ";"
+        content += "\n" + "}\n" * depth
+        notes.append(f"closed {depth} open block(s)")
+    return content, notes
+
+def repair_commands(commands):
+    """Validate generated HTML/CSS in create_update commands and fix them in place. Returns repair notes."""
+    notes = []
+    for command in commands:
+        if not isinstance(command, dict) or command.get("action") != "create_update": continue
+        filename, content = command.get("filename") or "", command.get("content")
+        if not isinstance(content, str): continue
+        suffix = Path(filename).suffix.lower()
+        # Partials are fragments: a layout header may open tags its footer closes, so only pages are balanced
+        if is_partial(filename): continue
+        if suffix in (".html", ".htm"): command["content"], file_notes = repair_html(content)
+        elif suffix == ".css": command["content"], file_notes = repair_css(content)
+        else: continue
+        notes.extend(f"`{filename}`: {note}" for note in file_notes)
+    return notes
+
+def _close_json(text):
+    """Close whatever strings, objects and arrays are open at the end of text. Also returns the comma positions."""
+    stack, commas, in_string, escaped = [], [], False, False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped: escaped = False
+            elif ch == "\\": escaped = True
+            elif ch == '"': in_string = False
+        elif ch == '"': in_string = True
+        elif ch in "[{": stack.append(ch)
+        elif ch in "]}" and stack: stack.pop()
+        elif ch == ",": commas.append(i)
+    if in_string: text += ('\\"' if escaped else '"')
+    text = text.rstrip().rstrip(",")
+    if text.endswith(":"): text += " null"
+    return text + "".join("]" if opener == "[" else "}" for opener in reversed(stack)), commas
+
+def repair_truncated_json(text):
+    """Make a cut-off JSON reply parseable by closing what it left open.
+
+    If the cut landed somewhere that can't be closed cleanly (e.g. right after a key),
+    it backs off to the previous comma. Returns the repaired text; json.loads may still fail on it.
+    """
+    candidate, commas = _close_json(text)
+    for cut in [None] + commas[::-1][:20]:
+        if cut is not None: candidate, _ = _close_json(text[:cut])
+        try:
+            json.loads(candidate)
+            return candidate
+        except json.JSONDecodeError:
+            continue
+    return candidate
+
+# --- Usage Accounting ---
+class UsageLedger:
+    """Per-call token, latency and retry records with running totals per session, user, model and feature.
+
+    Totals live in the shared state store, so budgets hold across replicas and restarts. This
+    process's records live in a fixed-size ring buffer and are appended to USAGE_LOG_PATH (JSON lines)
+    every USAGE_FLUSH_SECONDS and at exit as an audit trail.
+    """
+    def __init__(self, store, log_path=USAGE_LOG_PATH):
+        self.store, self.log_path = store, log_path
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=USAGE_RING_SIZE)
+        self._unflushed = []
+        self._parse_outcomes = Counter()  # (output mode, outcome) -> replies
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def cost(model, prompt_tokens, completion_tokens):
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+    def record(self, session_id, user_id, model, feature, usage, latency, retries, ok=True):
+        record = {
+            "ts": time.time(), "session_id": session_id, "user_id": user_id, "model": model, "feature": feature,
+            "prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0),
+            "cached_tokens": usage.get("cached_tokens", 0), "latency": round(latency, 3), "retries": retries, "ok": ok,
+        }
+        record["cost"] = self.cost(model, record["prompt_tokens"], record["completion_tokens"])
+        amounts = {field: record[field] for field in ("prompt_tokens", "completion_tokens", "cached_tokens", "cost", "latency", "retries")}
+        amounts.update(calls=1, failures=0 if ok else 1)
+        for dimension, key in (("session", session_id), ("user", user_id), ("model", model), ("feature", feature)):
+            # Session totals only matter while the session can still be resumed
+            try: self.store.add("usage", f"{dimension}:{key}", amounts, ttl=SESSION_HISTORY_TTL_SECONDS if dimension == "session" else None)
+            except sqlite3.Error as e: logger.warning("could not record usage for %s %s: %s", dimension, key, e)
+        with self._lock:
+            self._records.append(record)
+            self._unflushed.append(record)
+            due = time.monotonic() - self._last_flush >= USAGE_FLUSH_SECONDS
+        if due: self.flush()
+        return record
+
+    def flush(self):
+        with self._lock:
+            pending, self._unflushed = self._unflushed, []
+            self._last_flush = time.monotonic()
+        if not pending: return
+        try:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record) + "\n" for record in pending)
+        except OSError as e:
+            logger.warning("could not flush usage log: %s", e)
+
+    def record_parse(self, outcome, mode=GROQ_OUTPUT_MODE):
+        """Count how a reply decoded: "clean", "repaired", "invalid" (some operations dropped) or "failed"."""
+        with self._lock: self._parse_outcomes[(mode, outcome)] += 1
+
+    def parse_stats(self):
+        """{mode: {"replies", "clean", "repaired", "invalid", "failed", "failure_rate"}}; failure covers failed and invalid."""
+        with self._lock: outcomes = dict(self._parse_outcomes)
+        stats = {}
+        for (mode, outcome), count in outcomes.items():
+            stats.setdefault(mode, Counter())[outcome] += count
+        for mode, counts in stats.items():
+            counts["replies"] = sum(counts.values())
+            stats[mode] = {**counts, "failure_rate": (counts["failed"] + counts["invalid"]) / counts["replies"]}
+        return stats
+
+    def totals(self, dimension, key):
+        try: return self.store.get("usage", f"{dimension}:{key}") or {}
+        except sqlite3.Error as e: logger.warning("could not read usage totals: %s", e); return {}
+
+    def breakdown(self, dimension):
+        """Totals for every key of one dimension ("session", "user", "model" or "feature")."""
+        try: items = self.store.items("usage")
+        except sqlite3.Error as e: logger.warning("could not read usage totals: %s", e); return {}
+        return {key.partition(":")[2]: totals for key, totals in items if key.partition(":")[0] == dimension}
+
+    def recent(self, limit=20):
+        with self._lock: return list(self._records)[-limit:]
+
+    def budget_exceeded(self, session_id, user_id):
+        """A user-facing message if the session or user budget is used up, else None."""
+        for dimension, key, budget in (("session", session_id, SESSION_TOKEN_BUDGET), ("user", user_id, USER_TOKEN_BUDGET)):
+            totals = self.totals(dimension, key)
+            used = totals.get("prompt_tokens", 0) + totals.get("completion_tokens", 0)
+            if budget and used >= budget:
+                return f"This {dimension} has used its token budget ({used:,} of {budget:,} tokens)."
+        return None
+
+@st.cache_resource
+def get_usage_ledger():
+    ledger = UsageLedger(get_state_store())
+    atexit.register(ledger.flush)
+    return ledger
 
 # --- AI Interaction & File Ops ---
-def parse_and_execute_commands(ai_response_text):
-    parsed_commands = []
+def decode_ai_commands(ai_response_text, allow_truncated=False):
+    """Parse the model's reply as JSON, stripping code fences and patching common quote-escaping mistakes.
+
+    Returns (payload, repaired), where repaired says whether any fix-up was needed.
+    allow_truncated=True also closes a cut-off reply; only pass it when the provider said the reply was cut off.
+    Raises json.JSONDecodeError when the reply can't be repaired.
+    """
+    # Clean up the response text
+    response_text_cleaned = ai_response_text.strip()
+    
+    # Handle various code block formats
+    if response_text_cleaned.startswith("```json") and response_text_cleaned.endswith("```"):
+        response_text_cleaned = response_text_cleaned[7:-3].strip()
+    elif response_text_cleaned.startswith("```") and response_text_cleaned.endswith("```"):
+        response_text_cleaned = response_text_cleaned[3:-3].strip()
+    
     try:
-        # Clean up the response text
-        response_text_cleaned = ai_response_text.strip()
-        
-        # Handle various code block formats
-        if response_text_cleaned.startswith("```json") and response_text_cleaned.endswith("```"):
-            response_text_cleaned = response_text_cleaned[7:-3].strip()
-        elif response_text_cleaned.startswith("```") and response_text_cleaned.endswith("```"):
-            response_text_cleaned = response_text_cleaned[3:-3].strip()
+        # First attempt to parse as is
+        return json.loads(response_text_cleaned), False
+    except json.JSONDecodeError:
+        pass
+    # Fix common JSON escaping issues
+    # This helps with quotes inside HTML/CSS content that might not be properly escaped
+    try:
+        # Unescaped quotes in HTML attributes are the most common mistake
+        return json.loads(escape_attribute_quotes(response_text_cleaned)), True
+    except json.JSONDecodeError:
+        pass
+    # Look for unescaped quotes in content fields
+    fixed_json = re.sub(r'("content": ")(.+?)(")', 
+                       lambda m: m.group(1) + m.group(2).replace('"', '\\"') + m.group(3), 
+                       response_text_cleaned, 
+                       flags=re.DOTALL)
+    try:
+        return json.loads(fixed_json), True
+    except json.JSONDecodeError:
+        pass
+    # If still failing, try a more aggressive approach for HTML attributes with quotes
+    # This regex looks for HTML attributes with unescaped quotes
+    fixed_json = re.sub(r'(content=".+?)(\s+\w+=")(.*?)(")', 
+                       lambda m: m.group(1) + m.group(2) + m.group(3).replace('"', '\\"') + m.group(4), 
+                       fixed_json, 
+                       flags=re.DOTALL)
+    try:
+        return json.loads(fixed_json), True
+    except json.JSONDecodeError:
+        pass
+    if not allow_truncated:
+        raise json.JSONDecodeError("reply looks cut off", response_text_cleaned, len(response_text_cleaned))
+    # Last resort: the reply may just be cut off, so close what it left open
+    if response_text_cleaned.startswith("```"):
+        response_text_cleaned = response_text_cleaned.split("\n", 1)[-1]
+    return json.loads(repair_truncated_json(response_text_cleaned)), True
+
+OPERATION_FIELDS = {  # action -> fields that must be strings
+    "create_update": ("filename", "content"),
+    "delete": ("filename",),
+    "use_template": ("template", "filename"),
+    "chat": ("content",),
+}
+
+def validate_operations(payload):
+    """Check a decoded reply against the operations schema.
+
+    Accepts {"operations": [...]} (JSON mode), a bare array (text mode) or a single operation.
+    Returns (valid operations, problems), one problem string per operation that was dropped.
+    """
+    if isinstance(payload, dict) and isinstance(payload.get("operations"), list): payload = payload["operations"]
+    elif isinstance(payload, dict) and "action" in payload: payload = [payload]
+    if not isinstance(payload, list): return [], [f"expected a list of operations, got {type(payload).__name__}"]
+    operations, problems = [], []
+    for number, operation in enumerate(payload, 1):
+        if not isinstance(operation, dict):
+            problems.append(f"#{number} is not an object"); continue
+        fields = OPERATION_FIELDS.get(operation.get("action"))
+        if fields is None:
+            problems.append(f"#{number} has unknown action {operation.get('action')!r}"); continue
+        missing = [field for field in fields if not isinstance(operation.get(field), str)]
+        if missing:
+            problems.append(f"#{number} ({operation['action']}) lacks {', '.join(missing)}"); continue
+        if not isinstance(operation.get("slots", {}), dict):
+            problems.append(f"#{number} ({operation['action']}) has non-object slots"); continue
+        operations.append(operation)
+    return operations, problems
+
+def decode_operations(ai_response_text, ledger, finish_reason=None):
+    """Decode and validate a reply, counting the outcome for the parse failure rate. No Streamlit calls.
+
+    Truncation repair only runs for a reply that stopped at max_tokens (finish_reason "length");
+    any other malformed reply fails, so the caller's salvage or error path handles it.
+    Returns (operations, problems); raises json.JSONDecodeError when nothing could be decoded.
+    """
+    try: payload, repaired = decode_ai_commands(ai_response_text, allow_truncated=finish_reason == "length")
+    except json.JSONDecodeError:
+        ledger.record_parse("failed")
+        raise
+    operations, problems = validate_operations(payload)
+    ledger.record_parse("invalid" if problems else "repaired" if repaired else "clean")
+    return operations, problems
+
+def execute_commands(commands):
+    """Apply a list of file operations to the workspace; returns the commands as recorded in chat."""
+    with workspace_lock():  # Another replica can't interleave its own batch with this one
+        return _execute_commands(commands)
+
+def _record_file(parsed_commands, filename, content):
+    """Make the chat record hold a file's final content, so the model's next full-file update keeps it."""
+    for recorded in reversed(parsed_commands):
+        if recorded.get("action") == "create_update" and recorded.get("filename") == filename:
+            recorded["content"] = content; return
+    parsed_commands.append({"action": "create_update", "filename": filename, "content": content})
+
+def _execute_commands(commands):
+    parsed_commands = []
+    templates = []  # CSS merged after the batch, so a later style.css write in the same reply doesn't drop it
+    # If workspace reset is needed, clear all files before processing new commands.
+    # A reply that writes no page only edits shared parts (partials, styles), so the pages are kept.
+    if st.session_state.workspace_reset_needed:
+        if any(isinstance(c, dict) and c.get("action") == "create_update" and is_page(c.get("filename") or "") for c in commands):
+            clear_workspace()
+        st.session_state.workspace_reset_needed = False
         
-        # Fix common JSON escaping issues
-        # This helps with quotes inside HTML/CSS content that might not be properly escaped
-        try:
-            # First attempt to parse as is
-            commands = json.loads(response_text_cleaned)
-        except json.JSONDecodeError as e:
-            # If that fails, try to fix common issues with quotes in HTML/CSS
-            # Look for unescaped quotes in content fields
-            fixed_json = re.sub(r'("content": ")(.+?)(")', 
-                               lambda m: m.group(1) + m.group(2).replace('"', '\\"') + m.group(3), 
-                               response_text_cleaned, 
-                               flags=re.DOTALL)
+    for command in commands:
+        if not isinstance(command, dict): 
+            parsed_commands.append({"action": "chat", "content": f"Skipped: {command}"}); 
+            continue
             
-            # Try again with the fixed JSON
-            try:
-                commands = json.loads(fixed_json)
-            except json.JSONDecodeError:
-                # If still failing, try a more aggressive approach for HTML attributes with quotes
-                # This regex looks for HTML attributes with unescaped quotes
-                fixed_json = re.sub(r'(content=".+?)(\s+\w+=")(.*?)(")', 
-                                   lambda m: m.group(1) + m.group(2) + m.group(3).replace('"', '\\"') + m.group(4), 
-                                   fixed_json, 
-                                   flags=re.DOTALL)
-                commands = json.loads(fixed_json)
+        action=command.get("action")
+        filename=command.get("filename")
+        content=command.get("content")
         
-        if not isinstance(commands, list): 
-            return [{"action": "chat", "content": f"AI (Non-list JSON): {ai_response_text}"}]
+        parsed_commands.append(command)
         
-        # If workspace reset is needed, clear all files before processing new commands
-        if st.session_state.workspace_reset_needed:
-            clear_workspace()
-            st.session_state.workspace_reset_needed = False
-            
-        for command in commands:
-            if not isinstance(command, dict): 
-                parsed_commands.append({"action": "chat", "content": f"Skipped: {command}"}); 
-                continue
-                
-            action=command.get("action")
-            filename=command.get("filename")
-            content=command.get("content")
-            
-            parsed_commands.append(command)
-            
-            if action=="create_update":
-                if filename and content is not None:
-                    if not save_file_content(filename, content): 
-                        st.warning(f"Failed save '{filename}'.")
-                else: 
-                    st.warning(f"⚠️ Invalid 'create_update': {command}")
-            elif action=="delete":
-                if filename: 
-                    delete_file(filename)
-                else: 
-                    st.warning(f"⚠️ Invalid 'delete': {command}")
-            elif action=="chat": 
-                pass
+        if action=="create_update":
+            if filename and content is not None:
+                if not save_file_content(filename, content): 
+                    st.warning(f"Failed save '{filename}'.")
             else: 
-                st.warning(f"⚠️ Unknown action '{action}': {command}")
-                
-        return parsed_commands
+                st.warning(f"⚠️ Invalid 'create_update': {command}")
+        elif action=="delete":
+            if filename: 
+                delete_file(filename)
+            else: 
+                st.warning(f"⚠️ Invalid 'delete': {command}")
+        elif action=="use_template":
+            template = get_template_index().templates.get(command.get("template"))
+            if template and filename:
+                page = apply_template(template, read_file_content(filename) or "", command.get("slots"))
+                save_file_content(filename, page); _record_file(parsed_commands, filename, page)
+                templates.append(template)
+            else: 
+                st.warning(f"⚠️ Invalid 'use_template': {command}")
+        elif action=="chat": 
+            pass
+        else: 
+            st.warning(f"⚠️ Unknown action '{action}': {command}")
+            
+    if templates:
+        css = merge_template_css(templates, read_file_content(CSS_FILENAME) or "")
+        save_file_content(CSS_FILENAME, css); _record_file(parsed_commands, CSS_FILENAME, css)
+    return parsed_commands
+
+def parse_and_execute_commands(ai_response_text, finish_reason=None):
+    try:
+        commands, problems = decode_operations(ai_response_text, get_usage_ledger(), finish_reason)
+        if problems and not commands: 
+            return [{"action": "chat", "content": f"AI (Unexpected JSON: {'; '.join(problems)}): {ai_response_text}"}]
+        
+        # Fix broken HTML/CSS locally instead of paying for a regeneration
+        repair_notes = repair_commands(commands)
+        executed_commands = execute_commands(commands)
+        if problems:
+            executed_commands.append({"action": "chat", "content": "⚠️ Skipped invalid operations: " + "; ".join(problems)})
+        if repair_notes:
+            executed_commands.append({"action": "chat", "content": "🔧 Repaired locally: " + "; ".join(repair_notes)})
+        return executed_commands
     except json.JSONDecodeError as e:
         st.error(f"🔴 Invalid JSON: {e}\nTxt:\n'{ai_response_text[:500]}...'")
         # Try to salvage what we can by manually extracting and saving files
@@ -663,92 +2325,216 @@ def parse_and_execute_commands(ai_response_text):
         return [{"action": "chat", "content": f"Error processing commands: {e}"}]
 
 # --- Updated call_groq Function for Groq API ---
-def call_groq(history):
+GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+OMITTED_BODY = "[omitted: an older version of {filename}; see its newest version and the workspace symbol map]"
+
+def compact_file_bodies(history, live_files):
+    """History where every file body but the newest one of each existing file is replaced by a stub.
+
+    The model can't read files, so the newest body of a live file is its only copy and stays;
+    superseded versions and deleted files are covered by the manifest and the symbol map.
+    """
+    latest = {}
+    for number, msg in enumerate(history):
+        if isinstance(msg, dict) and isinstance(msg.get("content"), list):
+            for command in msg["content"]:
+                if isinstance(command, dict) and command.get("action") == "create_update":
+                    latest[command.get("filename")] = number
+    compacted = []
+    for number, msg in enumerate(history):
+        if isinstance(msg, dict) and isinstance(msg.get("content"), list):
+            msg = {**msg, "content": [
+                {**command, "content": OMITTED_BODY.format(filename=command.get("filename"))}
+                if isinstance(command, dict) and command.get("action") == "create_update"
+                and (latest.get(command.get("filename")) != number or command.get("filename") not in live_files)
+                else command
+                for command in msg["content"]
+            ]}
+        compacted.append(msg)
+    return compacted
+
+def build_groq_messages(history):
+    index = scan_workspace()
     # Convert history to Groq format
     groq_messages = []
-    for msg in history:
+    for msg in compact_file_bodies(history, index):
         if isinstance(msg, dict) and "role" in msg and "content" in msg:
             # Groq API expects "user" and "assistant" roles
             role = msg["role"]  # Groq uses "assistant" role directly
-            content = str(msg["content"])
+            content = msg["content"]
+            # Executed command lists are re-serialized the same way every time to keep the prefix stable
+            content = serialize_operations(content) if isinstance(content, list) else str(content)
             groq_messages.append({"role": role, "content": content})
 
-    instruction = """
-    You are an AI assistant that helps users create web pages and simple web applications.
-    Your goal is to generate HTML, CSS, JavaScript code, or self-contained React preview files.
-    Based on the user's request, you MUST respond ONLY with a valid JSON array containing file operation objects.
-
-    **JSON FORMATTING RULES (VERY IMPORTANT):**
-    1.  The entire response MUST be a single JSON array starting with '[' and ending with ']'.
-    2.  All keys (like "action", "filename", "content") MUST be enclosed in **double quotes** (").
-    3.  All string values (like filenames and the large code content) MUST be enclosed in **double quotes** ("). Single quotes (') or backticks (`) are NOT ALLOWED for keys or string values in the JSON structure.
-    4.  Special characters within the "content" string (like newlines, double quotes inside the code) MUST be properly escaped (e.g., use '\\n' for newlines, '\\"' for double quotes).
-
-    **EXAMPLE of Correct JSON action object:**
-    {
-        "action": "create_update",
-        "filename": "example.html",
-        "content": "<!DOCTYPE html>\\n<html>\\n<head>\\n  <title>Example</title>\\n</head>\\n<body>\\n  <h1>Hello World!</h1>\\n  <p>This contains a \\"quote\\" example.</p>\\n</body>\\n</html>"
+    # Static prefix first (byte-identical on every call), then the append-only history,
+    # then the volatile workspace manifest, so provider-side prompt caching can reuse the prefix.
+    json_mode = GROQ_OUTPUT_MODE == "json"
+    messages = [
+        {"role": "system", "content": JSON_MODE_INSTRUCTION if json_mode else SYSTEM_INSTRUCTION},
+        {"role": "assistant", "content": JSON_MODE_ACK if json_mode else ASSISTANT_ACK},
+    ]
+    messages.extend(groq_messages)
+    messages.append({"role": "system", "content": build_workspace_manifest(index)})
+    symbol_map = get_symbol_index().symbol_map()
+    if symbol_map:
+        messages.append({"role": "system", "content": symbol_map})
+    last_prompt = next((m["content"] for m in reversed(groq_messages) if m["role"] == "user"), "")
+    template_suggestions = build_template_suggestions(last_prompt)
+    if template_suggestions:
+        messages.append({"role": "system", "content": template_suggestions})
+    return messages
+
+def request_groq_completion(messages, temperature=0.7, seed=None, json_mode=False):
+    """POST one chat completion and return the raw response. json_mode asks the provider for a JSON object.
+
+    Makes no Streamlit calls, so it is safe to use from worker threads.
+    Raises requests.exceptions.RequestException on transport errors.
+    """
+    headers = {
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    data = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": 8000  # Increased token limit to handle larger responses
     }
+    if seed is not None:
+        data["seed"] = seed
+    if json_mode:
+        data["response_format"] = {"type": "json_object"}
+    return requests.post(GROQ_API_URL, headers=headers, json=data)
 
-    Possible action objects in the JSON array:
-    - {"action": "create_update", "filename": "path/to/file.ext", "content": "file content string here..."}
-    - {"action": "delete", "filename": "path/to/file.ext"}
-    - {"action": "chat", "content": "Your helpful answer string here..."}
+def extract_response_text(response_json):
+    """The assistant text from a chat completion, or None if the structure is unexpected."""
+    choices = response_json.get("choices") or []
+    if not choices or "content" not in (choices[0].get("message") or {}):
+        return None
+    # Extracting the response text from Groq API structure
+    return choices[0]["message"]["content"]
 
-    **VERY IMPORTANT - UPDATING FILES:**
-    If the user asks you to modify an existing file (e.g., "add a footer to index.html", "change the button color in style.css"), you MUST provide the **ENTIRE**, complete, updated file content within the 'content' field of the 'create_update' action object, following all JSON formatting rules. Do NOT provide only the changed lines or a diff.
+def failed_json_generation(response):
+    """The rejected text from a JSON-mode 400 (json_validate_failed), or None for any other response."""
+    if response.status_code != 400: return None
+    try: error = response.json().get("error") or {}
+    except ValueError: return None
+    return error.get("failed_generation") if error.get("code") == "json_validate_failed" else None
 
-    **REACT PREVIEWS:**
-    If the user asks for a simple React component/app to preview, generate a SINGLE self-contained HTML file (e.g., 'react_preview.html') using 'create_update'. This file MUST use CDN links for React/ReactDOM/Babel, have a <div id="root">, include JSX in a <script type="text/babel"> tag, render to the root, and include CSS in <style> tags within the <head>. (Ensure valid JSON).
+def escape_attribute_quotes(response_text):
+    # Fallback for replies that aren't valid JSON: escape the quotes of HTML attributes.
+    # Only used after a failed parse, since on valid JSON it would corrupt the content.
+    return re.sub(r'(<[^>]*?)="([^"]*?)"', 
+                  lambda m: m.group(1) + '=\\"' + m.group(2) + '\\"', 
+                  response_text)
 
-    **GENERAL:**
-    Use standard filenames ('index.html', 'style.css', 'script.js'). The standard CSS file for injection is 'style.css'. If unsure, ask the user. Respond ONLY with the JSON array. Use 'chat' action for questions or explanations.
-    
-    **ESCAPING QUOTES:**
-    When including HTML or CSS with attributes that contain quotes, you MUST properly escape all double quotes within the content. For example:
-    - HTML: <div class="container"> should be written as <div class=\\"container\\">
-    - CSS: font-family: "Times New Roman" should be written as font-family: \\"Times New Roman\\"
+def _merge_continuation(text, continuation):
+    """Append a continuation, dropping any overlap where the model repeated the end of its last reply."""
+    # Short overlaps are usually coincidence (e.g. both sides happen to share a quote), so require 16+ chars
+    for overlap in range(min(len(text), len(continuation), 200), 15, -1):
+        if text.endswith(continuation[:overlap]):
+            return text + continuation[overlap:]
+    return text + continuation
+
+def _request_with_retries(messages, temperature, seed, result, json_mode=False):
+    """One completion request, retried with backoff on 429/5xx. Counts attempts in result."""
+    for attempt in range(GROQ_MAX_RETRIES + 1):
+        response = request_groq_completion(messages, temperature=temperature, seed=seed, json_mode=json_mode)
+        result["requests"] += 1
+        if response.status_code not in RETRYABLE_STATUS_CODES or attempt == GROQ_MAX_RETRIES:
+            return response
+        result["retries"] += 1
+        try: delay = float(response.headers.get("retry-after", 0))
+        except (TypeError, ValueError): delay = 0
+        time.sleep(min(max(delay, 2 ** attempt), 8))
+
+def request_full_completion(messages, temperature=0.7, seed=None):
+    """Request a completion and, if it stops at max_tokens, ask the model to continue where it stopped.
+
+    Returns {"response", "text", "finish_reason", "requests", "retries", "continuations", "usage", "latency"},
+    where "retries" counts only 429/5xx re-sends and "continuations" the follow-up requests for a cut-off reply;
+    "text" is None when a request failed or the reply had an unexpected structure.
+    In JSON mode a reply the provider rejected as invalid JSON is still returned as "text"
+    (finish_reason "json_validate_failed"), so it can be repaired locally.
+    Usage is summed over every request made. No Streamlit calls (safe in worker threads).
     """
-    current_files = get_workspace_files()
-    file_list_prompt = f"Current files in workspace: {', '.join(current_files) if current_files else 'None'}"
-    
-    # Add system message at the beginning
-    system_message = {
-        "role": "system", 
-        "content": instruction
-    }
-    
-    # Prepare messages for Groq API
-    messages = [system_message]
-    
-    # Add a confirmation message from assistant to acknowledge the instructions
-    messages.append({
-        "role": "assistant", 
-        "content": "[{\"action\": \"chat\", \"content\": \"Okay, I understand the strict JSON formatting rules (double quotes, escaping) and the need to provide full file content on updates. I will respond only with the valid JSON array. Ready.\"}]"
-    })
-    
-    # Add user history
-    for msg in groq_messages:
-        messages.append(msg)
+    result = {"response": None, "text": None, "finish_reason": None, "requests": 0, "retries": 0, "continuations": 0,
+              "usage": {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}, "latency": 0.0}
+    started = time.monotonic()
+    text, request_messages = "", messages
+    for _ in range(MAX_CONTINUATIONS + 1):
+        # JSON mode can't continue a partial object, so continuations are requested as plain text
+        json_mode = GROQ_OUTPUT_MODE == "json" and not text
+        response = _request_with_retries(request_messages, temperature, seed, result, json_mode=json_mode)
+        result["response"] = response
+        result["latency"] = time.monotonic() - started
+        if response.status_code != 200:
+            rejected = failed_json_generation(response) if json_mode else None
+            if rejected is None: return result
+            text = rejected
+            try:
+                decode_ai_commands(rejected, allow_truncated=False)
+                logger.info("json mode rejected the reply (%d chars), repairing it locally", len(rejected))
+                result["finish_reason"] = "json_validate_failed"
+                break
+            except json.JSONDecodeError:
+                # Only closing what it left open would "fix" it, so it was cut off: continue it like a max_tokens stop
+                result["finish_reason"] = "length"
+        else:
+            response_json = response.json()
+            usage = response_json.get("usage") or {}
+            result["usage"]["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            result["usage"]["completion_tokens"] += usage.get("completion_tokens") or 0
+            result["usage"]["cached_tokens"] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+            chunk = extract_response_text(response_json)
+            if chunk is None: return result
+            text = _merge_continuation(text, chunk) if text else chunk
+            result["finish_reason"] = (response_json.get("choices") or [{}])[0].get("finish_reason")
+            if result["finish_reason"] != "length": break
+        logger.info("reply truncated at max_tokens, requesting continuation (%d chars so far)", len(text))
+        request_messages = messages + [{"role": "assistant", "content": text}, {"role": "user", "content": CONTINUE_PROMPT}]
+        result["continuations"] += 1
+    result["text"] = text
+    return result
+
+def recorded_completion(ledger, session_id, user_id, feature, messages, **kwargs):
+    """request_full_completion plus its usage record. A transport error is recorded as a failed call and re-raised."""
+    started = time.monotonic()
+    try: completion = request_full_completion(messages, **kwargs)
+    except Exception:
+        ledger.record(session_id, user_id, model_name, feature, {}, time.monotonic() - started, 0, ok=False)
+        raise
+    ledger.record(session_id, user_id, model_name, feature, completion["usage"],
+                  completion["latency"], completion["retries"], ok=completion["text"] is not None)
+    return completion
+
+def call_groq(history, feature="chat"):
+    st.session_state.last_finish_reason = None
+    messages = build_groq_messages(history)
+    ledger = get_usage_ledger()
+    budget_message = ledger.budget_exceeded(st.session_state.session_id, get_user_id())
+    if budget_message:
+        st.warning(f"🟠 {budget_message}")
+        return json.dumps([{"action": "chat", "content": f"{budget_message} No request was sent."}])
     
     try:
-        # Groq API endpoint
-        url = "https://api.groq.com/openai/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {GROQ_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        data = {
-            "model": model_name,
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 8000  # Increased token limit to handle larger responses
-        }
-        
-        response = requests.post(url, headers=headers, json=data)
+        scheduler = get_generation_scheduler()
+        queue_notice = st.empty()
+        ticket = scheduler.acquire(get_user_id(), on_wait=lambda position: queue_notice.info(
+            f"⏳ The server is busy. You are number {position} in the queue..."))
+        queue_notice.empty()
+        if ticket is None:
+            st.warning("🟠 Too many requests are waiting right now. Please try again in a minute.")
+            return json.dumps([{"action": "chat", "content": "The server is at capacity, so this request was not sent. Please try again shortly."}])
+        try:
+            completion = recorded_completion(ledger, st.session_state.session_id, get_user_id(), feature, messages)
+        finally:
+            scheduler.release(ticket)
+        response = completion["response"]
+        st.session_state.last_finish_reason = completion["finish_reason"]
         
-        if response.status_code != 200:
+        if response.status_code != 200 and completion["text"] is None:
             if response.status_code == 429:
                 st.error("🔴 Groq API Rate Limit Exceeded.")
             elif response.status_code == 401 or response.status_code == 403:
@@ -758,27 +2544,18 @@ def call_groq(history):
             error_content = f"Error calling AI: {response.text}".replace('"',"'")
             return json.dumps([{"action": "chat", "content": error_content}])
         
-        response_json = response.json()
+        # Report prompt-cache effectiveness when the provider includes it
+        usage = completion["usage"]
+        if usage["cached_tokens"]:
+            logger.info("groq usage prompt_tokens=%s cached_tokens=%s", usage["prompt_tokens"], usage["cached_tokens"])
+        st.session_state.last_usage = {"prompt_tokens": usage["prompt_tokens"], "cached_tokens": usage["cached_tokens"]}
         
-        # Check if the response contains the expected structure
-        if 'choices' in response_json and len(response_json['choices']) > 0:
-            if 'message' in response_json['choices'][0] and 'content' in response_json['choices'][0]['message']:
-                # Extracting the response text from Groq API structure
-                response_text = response_json['choices'][0]['message']['content']
-                
-                # Pre-process the response to fix common JSON issues
-                # Replace unescaped quotes in HTML attributes
-                response_text = re.sub(r'(<[^>]*?)="([^"]*?)"', 
-                                      lambda m: m.group(1) + '=\\"' + m.group(2) + '\\"', 
-                                      response_text)
-                
-                return response_text
-            else:
-                st.error("🔴 Unexpected Groq API response structure.")
-                return json.dumps([{"action": "chat", "content": "Error: Unexpected API response structure"}])
-        else:
-            st.error("🔴 Empty or invalid Groq API response.")
-            return json.dumps([{"action": "chat", "content": "Error: Empty or invalid API response"}])
+        if completion["text"] is None:
+            st.error("🔴 Unexpected Groq API response structure.")
+            return json.dumps([{"action": "chat", "content": "Error: Unexpected API response structure"}])
+        if completion["finish_reason"] == "length":
+            st.warning("🟠 The reply was still cut off after asking the AI to continue; incomplete files will be repaired locally.")
+        return completion["text"]
     except requests.exceptions.RequestException as e:
         st.error(f"🔴 Groq API call failed: {e}")
         error_content = f"Error calling AI: {str(e)}".replace('"',"'")
@@ -788,17 +2565,194 @@ def call_groq(history):
         error_content = f"Error calling AI: {str(e)}".replace('"',"'")
         return json.dumps([{"action": "chat", "content": error_content}])
 
+# --- Variant Generation (best-of-N) ---
+def write_variant_files(commands, root):
+    """Apply create_update/delete commands to a scratch directory. No Streamlit calls (runs in workers)."""
+    templates = []
+    for command in commands:
+        if not isinstance(command, dict): continue
+        filename = command.get("filename")
+        if not filename or ".." in filename or filename.startswith(("/", "\\")): continue
+        filepath = root / filename
+        if command.get("action") == "create_update" and command.get("content") is not None:
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            filepath.write_text(command["content"], encoding="utf-8")
+        elif command.get("action") == "delete":
+            filepath.unlink(missing_ok=True)
+        elif command.get("action") == "use_template":
+            template = get_template_index().templates.get(command.get("template"))
+            if not template: continue
+            page = apply_template(template, filepath.read_text(encoding="utf-8") if filepath.exists() else "", command.get("slots"))
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            filepath.write_text(page, encoding="utf-8"); templates.append(template)
+    if templates:  # After the batch, so a style.css written later in the same reply keeps the template CSS
+        css_path = root / CSS_FILENAME
+        css_path.write_text(merge_template_css(templates, css_path.read_text(encoding="utf-8") if css_path.exists() else ""), encoding="utf-8")
+
+def _generate_variant(messages, index, root, seed_workspace, context):
+    """Worker: one generation written into its own scratch workspace. Returns a result dict, never raises.
+
+    context carries the process-wide scheduler and ledger plus the caller's ids, since
+    worker threads can't read Streamlit session state.
+    """
+    temperature = VARIANT_TEMPERATURES[index % len(VARIANT_TEMPERATURES)]
+    result = {"index": index, "dir": str(root), "temperature": temperature, "commands": None, "error": None}
+    try:
+        shutil.rmtree(root, ignore_errors=True)
+        if seed_workspace: shutil.copytree(WORKSPACE_DIR, root)
+        else: root.mkdir(parents=True)
+        ticket = context["scheduler"].acquire(context["user_id"])
+        if ticket is None:
+            result["error"] = "The server is at capacity."
+            return result
+        try:
+            completion = recorded_completion(context["ledger"], context["session_id"], context["user_id"], "variant",
+                                             messages, temperature=temperature, seed=index + 1)
+        finally:
+            context["scheduler"].release(ticket)
+        if completion["text"] is None and completion["response"].status_code != 200:
+            result["error"] = f"Groq API call failed with status {completion['response'].status_code}."
+            return result
+        commands = decode_operations(completion["text"], context["ledger"], completion["finish_reason"])[0] if completion["text"] is not None else None
+        if not commands:
+            result["error"] = "Unexpected response from the AI."
+            return result
+        repair_commands(commands)
+        write_variant_files(commands, root)
+        result["commands"] = commands
+    except json.JSONDecodeError as e:
+        result["error"] = f"Invalid JSON: {e}"
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+def generate_variants(history, count):
+    """Run `count` generations of the same prompt concurrently, each at its own temperature and seed."""
+    messages = build_groq_messages(history)
+    session_dir = VARIANTS_DIR / st.session_state.session_id
+    shutil.rmtree(session_dir, ignore_errors=True)
+    context = {"scheduler": get_generation_scheduler(), "ledger": get_usage_ledger(),
+               "user_id": get_user_id(), "session_id": st.session_state.session_id}
+    budget_message = context["ledger"].budget_exceeded(context["session_id"], context["user_id"])
+    if budget_message:
+        st.warning(f"🟠 {budget_message}")
+        return []
+    # A new prompt starts from an empty workspace, a follow-up edits a copy of the current one
+    seed_workspace = not st.session_state.workspace_reset_needed
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        futures = [pool.submit(_generate_variant, messages, i, session_dir / f"v{i + 1}", seed_workspace, context)
+                   for i in range(count)]
+        return [future.result() for future in futures]
+
+def render_variant_preview(root):
+    """Thumbnail-scale HTML for a variant: its index.html (or first page) with style.css injected."""
+    pages = sorted(p.relative_to(root).as_posix() for p in root.rglob("*.htm*") if p.is_file() and is_page(p.name))
+    if not pages: return None
+    page = "index.html" if "index.html" in pages else pages[0]
+    def read_variant_file(rel_path):
+        try: return (root / rel_path).read_text(encoding="utf-8", errors="replace")
+        except OSError: return None
+    html = inline_assets(expand_includes(read_variant_file(page), page, read_variant_file)[0], page, root)
+    styles = "<style>html { zoom: 0.5; }</style>"
+    css_path = root / CSS_FILENAME
+    if css_path.exists():
+        styles += f"<style>\n{inline_assets(css_path.read_text(encoding='utf-8', errors='replace'), CSS_FILENAME, root)}\n</style>"
+    return html.replace("</head>", f"{styles}\n</head>", 1) if "</head>" in html else styles + html
+
+def discard_variants(record=True):
+    """Drop the variant grid. Unless a variant was promoted, answer the pending prompt in chat so turns keep alternating."""
+    shutil.rmtree(VARIANTS_DIR / st.session_state.session_id, ignore_errors=True)
+    st.session_state.variants = []
+    if record:
+        st.session_state.messages.append({"role": "assistant", "content": [{"action": "chat", "content": "Discarded the generated variants; no files were changed."}]})
+
+def promote_variant(variant):
+    """Apply the chosen variant's commands to the main workspace and record them in chat."""
+    executed_commands = execute_commands(variant["commands"])
+    st.session_state.messages.append({"role": "assistant", "content": executed_commands})
+    discard_variants(record=False)
+
+# --- Speculative Pre-warming ---
+def _normalize_prompt(prompt):
+    return " ".join(re.sub(r"[^a-z0-9 ]+", " ", prompt.lower()).split())
+
+def match_followup(prompt):
+    """The PREWARM_FOLLOWUPS entry a prompt asks for, or None."""
+    normalized = _normalize_prompt(prompt)
+    for followup, phrasings in PREWARM_FOLLOWUPS.items():
+        if normalized == _normalize_prompt(followup) or normalized in phrasings:
+            return followup
+    return None
+
+def prewarm_cache_key(session_id, signature, followup):
+    """Scoped to the session that paid for it: the reply was generated from that session's history."""
+    return hashlib.sha256(f"{session_id}\0{signature}\0{followup}".encode("utf-8")).hexdigest()
+
+def _prewarm_followups(jobs, signature, context):
+    """Worker: generate the likely follow-ups one at a time while the server is idle and cache
+    their command arrays against the session and workspace signature, spending (and recording
+    usage against) the requesting session's budget. Never raises; no Streamlit calls.
+    """
+    spent = 0
+    for followup, messages in jobs:
+        cache_key = prewarm_cache_key(context["session_id"], signature, followup)
+        try:
+            if context["store"].get("prewarm", cache_key) is not None: continue
+            if context["ledger"].budget_exceeded(context["session_id"], context["user_id"]): return
+            deadline = time.monotonic() + PREWARM_IDLE_WAIT_SECONDS
+            ticket = context["scheduler"].try_acquire_idle(context["user_id"])
+            while ticket is None and time.monotonic() < deadline:
+                time.sleep(QUEUE_POLL_SECONDS)
+                ticket = context["scheduler"].try_acquire_idle(context["user_id"])
+            if ticket is None:
+                logger.info("prewarm stopped: no idle capacity")
+                return
+            try:
+                completion = recorded_completion(context["ledger"], context["session_id"], context["user_id"], "prewarm", messages)
+            finally:
+                context["scheduler"].release(ticket)
+            spent += completion["usage"]["prompt_tokens"] + completion["usage"]["completion_tokens"]
+            if completion["text"] is not None and completion["finish_reason"] not in ("length", "json_validate_failed"):
+                commands, problems = decode_operations(completion["text"], context["ledger"])
+                if commands and not problems:
+                    repair_commands(commands)
+                    context["store"].set("prewarm", cache_key, commands, ttl=PREWARM_CACHE_TTL_SECONDS)
+                    logger.info("prewarmed followup=%r tokens=%d", followup, spent)
+        except Exception as e:
+            logger.warning("prewarm of %r failed: %s", followup, e)
+        if spent >= PREWARM_TOKEN_BUDGET:
+            logger.info("prewarm stopped: round budget of %d tokens used", PREWARM_TOKEN_BUDGET)
+            return
+
+def start_prewarm(history):
+    """Generate the likely follow-ups to the current workspace in the background, once per workspace state."""
+    signature = workspace_signature(scan_workspace())
+    if st.session_state.get("prewarm_signature") == signature: return
+    st.session_state.prewarm_signature = signature
+    context = {"scheduler": get_generation_scheduler(), "ledger": get_usage_ledger(), "store": get_state_store(),
+               "user_id": get_user_id(), "session_id": st.session_state.session_id}
+    jobs = [(followup, build_groq_messages(history + [{"role": "user", "content": followup}])) for followup in PREWARM_FOLLOWUPS]
+    threading.Thread(target=_prewarm_followups, args=(jobs, signature, context), name="prewarm", daemon=True).start()
+
+def take_prewarmed(prompt):
+    """Commands this session pre-generated for this prompt against the current workspace, or None."""
+    followup = match_followup(prompt)
+    if followup is None: return None
+    try: return get_state_store().get("prewarm", prewarm_cache_key(st.session_state.session_id, workspace_signature(scan_workspace()), followup))
+    except sqlite3.Error as e: logger.warning("prewarm cache unavailable: %s", e); return None
+
 # --- Sidebar: Extended with About and How to Use sections ---
 with st.sidebar:
     # Logo or Brand
     st.markdown('<div class="sidebar-brand"><h1>A Personal Website Builder</h1></div>', unsafe_allow_html=True)
     
     # Sidebar Tabs
-    sidebar_tabs = ["about", "how_to_use", "chat"]
+    sidebar_tabs = ["about", "how_to_use", "chat", "usage"]
     tab_icons = {
         "about": "ℹ️ About",
         "how_to_use": "🕯️ How to Use",
-        "chat": "💬 Chat with AI"
+        "chat": "💬 Chat with AI",
+        "usage": "📊 Usage"
     }
     
     selected_tab = st.radio("Navigation", options=sidebar_tabs, format_func=lambda x: tab_icons.get(x, x), key="sidebar_tabs", label_visibility="visible")
@@ -855,6 +2809,10 @@ with st.sidebar:
     elif st.session_state.active_tab == "chat":
         st.markdown('<h2 style="font-family: \'Orbitron\', sans-serif; color: #f5c2e7;">Chat with AI</h2>', unsafe_allow_html=True)
         st.caption(f"Using Model: `{model_name}`")
+        load = get_generation_scheduler().metrics()
+        if st.session_state.get("last_usage", {}).get("cached_tokens") is not None:
+            st.caption(f"Last request: {st.session_state.last_usage['prompt_tokens']} prompt tokens, {st.session_state.last_usage['cached_tokens']} served from cache")
+        st.caption(f"Server load: {load['in_flight']}/{load['max_inflight']} generating · {load['queued']} queued · p95 wait {load['p95_wait']:.1f}s")
         
         chat_container = st.container(height=500)
         with chat_container:
@@ -868,6 +2826,7 @@ with st.sidebar:
                                 action = command.get("action"); filename = command.get("filename")
                                 if action == "create_update": display_text += f"📝 Create/Update: `{filename}`\n"
                                 elif action == "delete": display_text += f"🗑️ Delete: `{filename}`\n"
+                                elif action == "use_template": display_text += f"🧩 Template `{command.get('template')}` → `{filename}`\n"
                                 elif action == "chat": chat_messages.append(command.get('content', '...'))
                                 else: display_text += f"⚠️ {command.get('content', f'Unknown action: {action}')}\n"
                             final_display = (display_text + "\n".join(chat_messages)).strip()
@@ -887,6 +2846,27 @@ with st.sidebar:
             else:
                 st.error("Failed to clear workspace.")
 
+    elif st.session_state.active_tab == "usage":
+        st.markdown('<h2 style="font-family: \'Orbitron\', sans-serif; color: #f5c2e7;">Usage</h2>', unsafe_allow_html=True)
+        ledger = get_usage_ledger()
+        for dimension, key, budget in (("session", st.session_state.session_id, SESSION_TOKEN_BUDGET), ("user", get_user_id(), USER_TOKEN_BUDGET)):
+            totals = ledger.totals(dimension, key)
+            used = totals.get("prompt_tokens", 0) + totals.get("completion_tokens", 0)
+            st.markdown(f"**This {dimension}:** {totals.get('calls', 0)} calls · {used:,} tokens ({totals.get('cached_tokens', 0):,} cached) · ${totals.get('cost', 0.0):.4f}")
+            if budget: st.progress(min(used / budget, 1.0), text=f"{used:,} / {budget:,} token budget")
+        for dimension in ("feature", "model", "user") if USAGE_ADMIN_VIEW else ("feature", "model"):
+            rows = [{dimension: key, "calls": t["calls"], "prompt": t["prompt_tokens"], "completion": t["completion_tokens"],
+                     "cached": t["cached_tokens"], "cost ($)": round(t["cost"], 4), "avg latency (s)": round(t["latency"] / t["calls"], 2),
+                     "retries": t["retries"], "failures": t["failures"]} for key, t in ledger.breakdown(dimension).items()]
+            if rows:
+                st.caption(f"By {dimension}")
+                st.dataframe(rows, hide_index=True)
+        for mode, stats in ledger.parse_stats().items():
+            st.markdown(f"**Output parsing ({mode} mode):** {stats['replies']} replies · {stats.get('repaired', 0)} repaired · "
+                        f"{stats.get('invalid', 0)} with invalid operations · {stats.get('failed', 0)} unparseable · "
+                        f"{stats['failure_rate']:.1%} failure rate")
+        if not ledger.breakdown("feature"): st.info("No AI calls recorded yet.")
+
 # --- Main Area: Modern UI with 3D effects ---
 # Main Title with modern styling
 st.markdown('<h1 class="main-title">Build a Website</h1>', unsafe_allow_html=True)
@@ -907,14 +2887,26 @@ with col2:
         # Create zip file
         zip_buffer = create_download_zip()
         if zip_buffer:
-            # Create download link
-            download_link = get_download_link(zip_buffer, "website_project.zip", "Download")
-            st.markdown(download_link, unsafe_allow_html=True)
+            # Served by Streamlit's media file manager from the cached archive, not inlined into the page
+            with zip_buffer:
+                st.download_button("Download", data=zip_buffer, file_name="website_project.zip", mime="application/zip",
+                                   icon=":material/download:", key="download_project_btn")
 
 st.markdown('</div>', unsafe_allow_html=True)
 
+# Best-of-N: generate several designs in parallel and pick one
+variant_col1, variant_col2 = st.columns([1, 3])
+with variant_col1:
+    st.toggle("🎲 Variants", key="variant_mode", help="Generate several designs for the same prompt in parallel and pick one")
+    st.toggle("⚡ Pre-warm", key="prewarm_mode", help="After each generation, prepare common follow-ups (responsive, dark mode, new colors) in the background so they apply instantly")
+with variant_col2:
+    if st.session_state.get("variant_mode"):
+        st.slider("Number of variants", min_value=2, max_value=MAX_VARIANTS, value=3, key="variant_count")
+
 # Process the prompt if provided
 if prompt:
+    # A new prompt replaces an unpicked variant grid; answer the previous prompt so turns keep alternating
+    if st.session_state.variants: discard_variants()
     # Set workspace_reset_needed flag to true when a new prompt is received
     if prompt != st.session_state.last_prompt:
         st.session_state.workspace_reset_needed = True
@@ -925,9 +2917,38 @@ if prompt:
     # Loading animation
     with st.spinner():
         st.markdown('<div class="loading-text">Your thoughts are coming alive...</div>', unsafe_allow_html=True)
-        ai_response_text = call_groq(st.session_state.messages)
-        executed_commands = parse_and_execute_commands(ai_response_text)
-        st.session_state.messages.append({"role": "assistant", "content": executed_commands})
+        if st.session_state.get("variant_mode"):
+            st.session_state.variants = generate_variants(st.session_state.messages, st.session_state.get("variant_count", 3))
+        else:
+            prewarmed_commands = take_prewarmed(prompt) if st.session_state.get("prewarm_mode") else None
+            if prewarmed_commands is not None:
+                executed_commands = execute_commands(prewarmed_commands)
+                executed_commands.append({"action": "chat", "content": "⚡ Applied a result prepared in the background."})
+            else:
+                ai_response_text = call_groq(st.session_state.messages)
+                executed_commands = parse_and_execute_commands(ai_response_text, st.session_state.last_finish_reason)
+            st.session_state.messages.append({"role": "assistant", "content": executed_commands})
+            if st.session_state.get("prewarm_mode"): start_prewarm(st.session_state.messages)
+        st.rerun()
+
+# --- Variant Grid ---
+if st.session_state.variants:
+    st.markdown('<h2 class="section-header">Pick a Variant</h2>', unsafe_allow_html=True)
+    variant_columns = st.columns(len(st.session_state.variants))
+    for column, variant in zip(variant_columns, st.session_state.variants):
+        with column:
+            st.caption(f"Variant {variant['index'] + 1} · temperature {variant['temperature']}")
+            if variant["error"]:
+                st.error(variant["error"])
+                continue
+            variant_html = render_variant_preview(Path(variant["dir"]))
+            if variant_html: st.components.v1.html(variant_html, height=300, scrolling=True)
+            else: st.info("No HTML page in this variant.")
+            if st.button("⬆️ Use this design", key=f"promote_variant_{variant['index']}"):
+                promote_variant(variant)
+                st.rerun()
+    if st.button("✖️ Discard variants", key="discard_variants_btn"):
+        discard_variants()
         st.rerun()
 
 # --- Main Area: Tabs with metallic finish ---
@@ -943,15 +2964,62 @@ with tab1:  # --- Workspace Tab ---
     if st.session_state.selected_file in options:
         try: current_selection_index = options.index(st.session_state.selected_file)
         except ValueError: st.session_state.selected_file = None
+    symbol_query = st.text_input("🔎 Find class, id or JS name", key="symbol_search", placeholder=".hero, #contact, toggleMenu")
+    if symbol_query.strip():
+        symbol_matches = get_symbol_index().search(symbol_query)
+        if not symbol_matches: st.caption("No matching symbols.")
+        for kind, name, files in symbol_matches:
+            locations = ", ".join(f"`{path}:{line}` ({role})" for path in sorted(files) for line, role in files[path][:5])
+            st.markdown(f"**{format_symbol_kind(kind, name)}** — {locations}")
+    with st.expander("⬆️ Upload assets (images, fonts, ...)"):
+        upload_folder = st.text_input("Folder", value="assets", key="upload_folder")
+        uploaded_files = st.file_uploader("Files", accept_multiple_files=True, key="asset_uploader")
+        for uploaded_file in uploaded_files or []:
+            upload_id = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+            if upload_id in st.session_state.saved_uploads: continue  # Uploader re-sends files on every rerun
+            target = f"{upload_folder.strip('/')}/{uploaded_file.name}" if upload_folder.strip("/") else uploaded_file.name
+            if save_uploaded_file(target, uploaded_file):
+                st.session_state.saved_uploads.add(upload_id); st.success(f"Uploaded: `{target}`")
+                time.sleep(0.5); st.rerun()
     selected_file_option = st.selectbox("Select file:", options=options, format_func=lambda x: "--- Select ---" if x is None else x, key="ws_file_select", index=current_selection_index)
     st.subheader("Edit Code")
     editor_key = f"editor_{st.session_state.selected_file or 'none'}"
     if selected_file_option != st.session_state.selected_file:
+        flush_section_edit(force=True)  # Don't lose a debounced edit when switching files
         st.session_state.selected_file = selected_file_option
-        st.session_state.file_content = read_file_content(st.session_state.selected_file) or "" if st.session_state.selected_file else ""
+        st.session_state.large_file = None
+        large = st.session_state.selected_file and is_large_file(st.session_state.selected_file)
+        st.session_state.file_content = read_file_content(st.session_state.selected_file) or "" if st.session_state.selected_file and not large else ""
         st.session_state.rendered_html = ""; st.session_state.pop(f"rendered_for_{st.session_state.selected_file}", None)
         st.rerun()
-    if st.session_state.selected_file:
+    if st.session_state.selected_file and is_binary_file(st.session_state.selected_file):
+        asset_path = WORKSPACE_DIR / st.session_state.selected_file
+        st.caption(f"Binary asset: `{st.session_state.selected_file}` ({asset_path.stat().st_size if asset_path.exists() else 0:,} bytes)")
+        if Path(st.session_state.selected_file).suffix.lower() in {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".ico"}:
+            st.image(str(asset_path))  # Streamlit serves it from disk
+        else:
+            st.info("Binary files can't be edited here. Reference them from your HTML/CSS and they'll be inlined in the preview.")
+    elif st.session_state.selected_file and is_large_file(st.session_state.selected_file):
+        # Large files: load one section at a time and write back only the edited byte range
+        large_file = st.session_state.large_file
+        stat = (WORKSPACE_DIR / st.session_state.selected_file).stat()
+        if not large_file or large_file["name"] != st.session_state.selected_file or large_file["signature"] != (stat.st_size, stat.st_mtime_ns):
+            flush_section_edit(force=True)
+            st.session_state.large_file = large_file = load_large_file(st.session_state.selected_file)
+        st.caption(f"Editing: `{st.session_state.selected_file}` ({stat.st_size:,} bytes, {len(large_file['sections'])} sections)")
+        section_labels = [section["label"] for section in large_file["sections"]]
+        section_index = st.selectbox("Section:", options=range(len(section_labels)), format_func=lambda i: section_labels[i], key=f"section_select_{st.session_state.selected_file}")
+        pending = st.session_state.pending_section_edit
+        if pending and pending["section"] != section_index:
+            flush_section_edit(force=True)
+        section = large_file["sections"][section_index]
+        section_key = f"section_editor_{st.session_state.selected_file}_{section_index}_{section['start']}_{section['end']}"
+        st.text_area("Code Editor", value=read_file_range(st.session_state.selected_file, section["start"], section["end"]),
+                     height=400, key=section_key, label_visibility="visible", on_change=queue_section_edit, args=(section_key, section_index))
+        if st.session_state.pending_section_edit and st.button("💾 Save now", key="save_section_btn"):
+            flush_section_edit(force=True); st.rerun()
+        autosave_section_edits()
+    elif st.session_state.selected_file:
         st.caption(f"Editing: `{st.session_state.selected_file}`")
         file_ext = Path(st.session_state.selected_file).suffix.lower()
         lang_map = {".html": "html", ".css": "css", ".js": "javascript", ".py":"python", ".md": "markdown", ".json": "json", ".jsx":"javascript", ".vue":"vue", ".svelte":"svelte", ".txt":"text"}
@@ -971,28 +3039,33 @@ with tab1:  # --- Workspace Tab ---
 with tab2:  # --- Preview Tab ---
     st.markdown('<h2 class="section-header">Live Preview</h2>', unsafe_allow_html=True)
     st.markdown("---")
-    css_applied_info = ""  # Initialize to prevent NameError
 
     if st.session_state.selected_file:
         if st.session_state.selected_file.lower().endswith(('.html', '.htm')):
-            current_file_content_for_preview = read_file_content(st.session_state.selected_file)
             rendered_marker_key = f"rendered_for_{st.session_state.selected_file}"
-            needs_render_update = False
-            if current_file_content_for_preview is not None:
-                needs_render_update = (not st.session_state.rendered_html or 
-                                      rendered_marker_key not in st.session_state or 
-                                      st.session_state[rendered_marker_key] != current_file_content_for_preview)
-                if needs_render_update:
+            # Only re-read and re-render when the page or something it depends on was written
+            preview_stamp = get_preview_graph().stamp(st.session_state.selected_file)
+            needs_render_update = (not st.session_state.rendered_html or 
+                                   st.session_state.get(rendered_marker_key) != preview_stamp)
+            if needs_render_update:
+                css_applied_info = ""  # Kept next to rendered_html, so cached reruns still show it
+                current_file_content_for_preview = read_built_page(st.session_state.selected_file)
+                if current_file_content_for_preview is not None:
                     # Check for CSS file and inject if found
                     css_content = read_file_content(CSS_FILENAME)
                     if css_content:
+                        css_content = inline_assets(css_content, CSS_FILENAME)
                         # Simple CSS injection - find </head> and insert style before it
                         if "</head>" in current_file_content_for_preview:
                             current_file_content_for_preview = current_file_content_for_preview.replace(
                                 "</head>", f"<style>\n{css_content}\n</style>\n</head>")
                             css_applied_info = f"✅ CSS from `{CSS_FILENAME}` injected."
+                    current_file_content_for_preview = inline_assets(current_file_content_for_preview, st.session_state.selected_file)
                     st.session_state.rendered_html = current_file_content_for_preview
-                    st.session_state[rendered_marker_key] = current_file_content_for_preview
+                    st.session_state.rendered_css_info = css_applied_info
+                    st.session_state[rendered_marker_key] = preview_stamp
+                else:
+                    st.session_state.rendered_html = ""
             
             # Display the preview
             if st.session_state.rendered_html:
@@ -1001,7 +3074,7 @@ with tab2:  # --- Preview Tab ---
                 st.components.v1.html(st.session_state.rendered_html, height=600, scrolling=True)
                 st.markdown('</div>', unsafe_allow_html=True)
                 
-                if css_applied_info: st.caption(css_applied_info)
+                if st.session_state.rendered_css_info: st.caption(st.session_state.rendered_css_info)
                 
                 # Create a proper HTML file for the new window
                 html_content = st.session_state.rendered_html
@@ -1034,6 +3107,18 @@ with tab2:  # --- Preview Tab ---
     else:
         st.info("Select a file to preview.")
 
+# --- External Change Watcher ---
+get_workspace_watcher()
+watched_paths = set()
+if st.session_state.selected_file:
+    watched_paths = get_preview_graph().dependencies(st.session_state.selected_file) | {st.session_state.selected_file}
+get_workspace_events().watch(st.session_state.session_id, watched_paths)
+refresh_on_external_changes()
+persist_session()
+if not st.session_state.resume_cookie_set:
+    set_resume_cookie()
+    st.session_state.resume_cookie_set = True
+
 # Add Font Awesome for icons
 st.markdown("""
 <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css">